@@ -6,41 +6,30 @@ import os.path
 import grp
 import pwd
 import re
-import tempfile
-import tarfile
-import pprint
-import difflib
-import shutil
-import gzip
-import bz2
-import lzma # pyliblzma
-import subprocess
-import argparse
+import zlib
+import collections
+import itertools
 import errno
 import glob
-import string
-from email.mime.text import MIMEText
-from email.header import Header
-from email.utils import formataddr
 import json
-import xmlrpclib
+import time
+import hashlib
+import sqlite3
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
-import urlparse
-import urllib2
+# Other modules are imported where they are needed, most commands only use
+# a few of them and ftpadmin is started often (see importtime.py)
 
 script_path = os.path.realpath(os.path.abspath(sys.argv[0]))
 script_dir = os.path.dirname(script_path) + '/git'
 
+# For semi_rdf, which lives inside gitadmin-bin
 sys.path.insert(0, '/home/admin/bin/git')
 sys.path.insert(0, script_dir)
 
-# Lives inside gitadmin-bin
-import semi_rdf
-
 DEBUG=True
 
 BUGZILLARPC=True
@@ -109,16 +98,68 @@ def version_cmp(a, b):
 
     return cmp(len(A), len(B))
 
+def _memoize(maxsize):
+    """Decorator which caches the results of a function taking a single
+    argument. The least recently used result is dropped when the cache
+    holds maxsize results."""
+    def decorator(func):
+        cache = collections.OrderedDict()
+
+        def wrapper(arg):
+            try:
+                value = cache.pop(arg)
+            except KeyError:
+                value = func(arg)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[arg] = value
+            return value
+
+        wrapper.__doc__ = func.__doc__
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+@_memoize(10000)
+def version_key(version):
+    """Returns a key to sort versions on
+
+    Sorting on this key gives exactly the same order as version_cmp"""
+    key = []
+    for part in re_version.findall(version.lstrip('0')):
+        if part == '-':
+            key.append((0,))
+        elif part == '.':
+            key.append((1,))
+        elif part.isdigit():
+            # version_cmp compares numbers with a leading zero as strings,
+            # these always sort before numbers without one
+            if part.startswith('0'):
+                key.append((3, 0, part))
+            else:
+                key.append((3, 1, len(part), part))
+        else:
+            # Strings are compared case insensitively, also against
+            # numbers. As a string never starts with a digit, the first
+            # character decides if it sorts before or after all numbers
+            part = part.upper()
+            key.append((2 if part < '0' else 4, part))
+    return tuple(key)
+
 def get_latest_version(versions, max_version=None):
     """Gets the latest version number
 
     if max_version is specified, gets the latest version number before
     max_version"""
     latest = None
+    latest_key = None
+    max_key = version_key(max_version) if max_version is not None else None
     for version in versions:
-        if ( latest is None or version_cmp(version, latest) > 0 ) \
-           and ( max_version is None or version_cmp(version, max_version) < 0 ):
+        key = version_key(version)
+        if ( latest is None or key > latest_key ) \
+           and ( max_key is None or key < max_key ):
             latest = version
+            latest_key = key
     return latest
 
 def human_size(size):
@@ -140,6 +181,61 @@ def human_size(size):
 
     return fmt % (size/float(lim/2**10), suf)
 
+def sha256_file(filename, blocksize=4*1024*1024):
+    """Returns the SHA-256 of a file as hexadecimal string
+
+    The file is read unbuffered in large blocks into one buffer; hashlib
+    releases the GIL while hashing these, so several files can be hashed
+    in parallel threads (see sha256_files)."""
+    sha256 = hashlib.sha256()
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    with open(filename, 'rb', 0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            sha256.update(view[:size])
+    return sha256.hexdigest()
+
+def sha256_files(filenames, threads=4):
+    """Returns the SHA-256 of each of the files, hashed in parallel"""
+    if threads <= 1 or len(filenames) <= 1:
+        return [sha256_file(filename) for filename in filenames]
+
+    import multiprocessing.pool
+    pool = multiprocessing.pool.ThreadPool(min(threads, len(filenames)))
+    try:
+        return pool.map(sha256_file, filenames, chunksize=1)
+    finally:
+        pool.terminate()
+
+def sha256sum_line(digest, filename):
+    """Returns the line sha256sum outputs for a file"""
+    if '\\' in filename or '\n' in filename or '\r' in filename:
+        filename = filename.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r')
+        return '\\%s  %s\n' % (digest, filename)
+    return '%s  %s\n' % (digest, filename)
+
+def read_sha256sum(filename):
+    """Returns the digests listed in a file created by sha256sum, keyed on
+    the filename"""
+    unescape = {'\\\\': '\\', '\\n': '\n', '\\r': '\r'}
+    digests = {}
+    with open(filename, 'r') as f:
+        for line in line_input(f):
+            escaped = line.startswith('\\')
+            if escaped:
+                line = line[1:]
+            digest, sep, name = line.partition(' ')
+            if not sep or name[:1] not in (' ', '*'):
+                continue
+            name = name[1:]
+            if escaped:
+                name = re.sub(r'\\[\\nr]', lambda m: unescape[m.group(0)], name)
+            digests[name] = digest
+    return digests
+
 def makedirs_chown(name, mode=0777, uid=-1, gid=-1):
     """Like os.makedirs, but also does a chown
     """
@@ -158,6 +254,24 @@ def makedirs_chown(name, mode=0777, uid=-1, gid=-1):
     os.mkdir(name, mode)
     os.chown(name, uid, gid)
 
+def move_file(src, dst, blocksize=16*1024*1024):
+    """Moves a file by renaming it; only if src and dst are on different
+    filesystems it is copied, in large blocks"""
+    try:
+        os.rename(src, dst)
+        return
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    import shutil
+
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, blocksize)
+    shutil.copystat(src, dst)
+    os.remove(src)
+
 def line_input (file):
     for line in file:
         if line[-1] == '\n':
@@ -165,91 +279,266 @@ def line_input (file):
         else:
             yield line
 
-class _LZMAProxy(object):
-    """Small proxy class that enables external file object
-       support for "r:lzma" and "w:lzma" modes. This is actually
-       a workaround for a limitation in lzma module's LZMAFile
-       class which (unlike gzip.GzipFile) has no support for
-       a file object argument.
-    """
+def news_head(a, b):
+    """Returns the (start, end) of the first lines inserted or replaced in b
+    compared to a, None if b only removes lines from a
+
+    This is the first insert or replace of difflib.SequenceMatcher(None, a,
+    b). Usually b is a with new lines added at the top. Where b is a with
+    lines added or removed in one place, this is found in linear time if
+    difflib is known to align the lines the same way (see _news_aligned).
+    Anything else is left to difflib."""
+    la, lb = len(a), len(b)
+    common = min(la, lb)
+    prefix = 0
+    while prefix < common and a[prefix] == b[prefix]:
+        prefix += 1
+
+    if prefix == la == lb:
+        return None
 
-    blocksize = 16 * 1024
+    suffix = 0
+    while suffix < common and a[la - suffix - 1] == b[lb - suffix - 1]:
+        suffix += 1
 
-    def __init__(self, fileobj, mode):
+    # If prefix + suffix is larger, the place of the change is ambiguous
+    if prefix + suffix == common and _news_aligned(a, b, prefix):
+        if lb <= la:
+            return None
+        return prefix, prefix + lb - la
+
+    import difflib
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b).get_opcodes():
+        if tag == 'replace' or tag == 'insert':
+            return j1, j2
+
+    return None
+
+def _news_aligned(a, b, pos):
+    """Returns if difflib matches the lines before pos and the lines after
+    the change (see news_head) with themselves
+
+    difflib matches the longest run of equal lines first, extended with
+    the equal lines around it. It ignores the lines which are popular in b
+    (autojunk), these break a run. A run matched elsewhere consists of
+    lines which b has twice or which were removed from a. If both the
+    start and the end have a longer run than that, they are matched with
+    themselves."""
+    lb = len(b)
+    end = lb - (min(len(a), lb) - pos)
+
+    counts = collections.Counter(b)
+    ntest = lb // 100 + 1 if lb >= 200 else None
+    removed = set(a[pos:pos + len(a) - lb]) if len(a) > lb else ()
+
+    def longest_run(lines, match):
+        longest = run = 0
+        for line in lines:
+            if match(line):
+                run += 1
+                if run > longest:
+                    longest = run
+            else:
+                run = 0
+        return longest
+
+    matched = lambda line: ntest is None or counts[line] <= ntest
+    elsewhere = longest_run(b, lambda line: matched(line) and (counts[line] > 1 or line in removed))
+    for part in (b[:pos], b[end:]):
+        if part and longest_run(part, matched) <= elsewhere:
+            return False
+
+    return True
+
+class _ForwardReader(object):
+    """Wraps a decompressed file object and keeps track of the position
+       itself. Forward seeks are done by reading and discarding large
+       blocks, which is a lot cheaper than the seek implementation of e.g.
+       gzip.GzipFile (reads 1KiB at a time). This allows TarInfo.check()
+       to do everything in one pass over the decompressed data.
+
+       Backward seeks are passed on to the wrapped file object.
+
+       If sinks are given, each of them is called with all data read, in
+       order and exactly once (data read again after a backward seek is not
+       passed on again).
+    """
+
+    def __init__(self, fileobj, blocksize, sinks=()):
         self.fileobj = fileobj
-        self.mode = mode
-        self.name = getattr(self.fileobj, "name", None)
-        self.init()
-
-    def init(self):
-#        import lzma
-        self.pos = 0
-        if self.mode == "r":
-            self.lzmaobj = lzma.LZMADecompressor()
+        self.blocksize = blocksize
+        self.sinks = sinks
+        self.pos = fileobj.tell()
+        self.fed = 0
+
+        if self.sinks and self.pos:
+            # Pass on what was read before wrapping the file object
+            pos = self.pos
             self.fileobj.seek(0)
-            self.buf = ""
-        else:
-            self.lzmaobj = lzma.LZMACompressor()
-
-    def read(self, size):
-        b = [self.buf]
-        x = len(self.buf)
-        while x < size:
-            raw = self.fileobj.read(self.blocksize)
-            if not raw:
-                break
-            try:
-                data = self.lzmaobj.decompress(raw)
-            except EOFError:
-                break
-            b.append(data)
-            x += len(data)
-        self.buf = "".join(b)
-
-        buf = self.buf[:size]
-        self.buf = self.buf[size:]
+            self.pos = 0
+            self.skip(pos)
+
+    def _feed(self, buf):
+        end = self.pos + len(buf)
+        if end > self.fed:
+            data = buf[self.fed - self.pos:] if self.fed > self.pos else buf
+            for sink in self.sinks:
+                sink(data)
+            self.fed = end
+
+    def read(self, size=-1):
+        buf = self.fileobj.read(size) if size >= 0 else self.fileobj.read()
+        if self.sinks:
+            self._feed(buf)
         self.pos += len(buf)
         return buf
 
-    def seek(self, pos):
+    def skip(self, size):
+        """Reads and discards up to size bytes
+
+        Returns the amount of bytes actually skipped"""
+        skipped = 0
+        while skipped < size:
+            buf = self.fileobj.read(min(size - skipped, self.blocksize))
+            if not buf:
+                break
+            if self.sinks:
+                self._feed(buf)
+            skipped += len(buf)
+            self.pos += len(buf)
+        return skipped
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
         if pos < self.pos:
-            self.init()
-        self.read(pos - self.pos)
+            self.fileobj.seek(pos)
+            self.pos = pos
+        else:
+            self.skip(pos - self.pos)
 
+    def tell(self):
+        return self.pos
 
-class XzTarFile(tarfile.TarFile):
+    def close(self):
+        self.fileobj.close()
 
-    OPEN_METH = tarfile.TarFile.OPEN_METH.copy()
-    OPEN_METH["xz"] = "xzopen"
+class _TeeReader(object):
+    """Wraps a file object opened for reading and calls each of the sinks
+       with all data of the file, in order and exactly once, regardless
+       of how the file is read or seeked. Anything skipped over is read by
+       the wrapper itself, finish() passes on the remainder of the file."""
 
-    @classmethod
-    def xzopen(cls, name, mode="r", fileobj=None, **kwargs):
-        """Open gzip compressed tar archive name for reading or writing.
-           Appending is not allowed.
-        """
-        if len(mode) > 1 or mode not in "rw":
-            raise ValueError("mode must be 'r' or 'w'")
-
-        if fileobj is not None:
-            fileobj = _LMZAProxy(fileobj, mode)
-        else:
-            fileobj = lzma.LZMAFile(name, mode)
+    def __init__(self, fileobj, sinks, blocksize):
+        self.fileobj = fileobj
+        self.sinks = sinks
+        self.blocksize = blocksize
+        self.fed = 0
+
+    def _feed(self, buf):
+        for sink in self.sinks:
+            sink(buf)
+        self.fed += len(buf)
+
+    def _catch_up(self, pos):
+        """Passes on the data up to pos that was not read yet"""
+        self.fileobj.seek(self.fed)
+        while self.fed < pos:
+            buf = self.fileobj.read(min(pos - self.fed, self.blocksize))
+            if not buf:
+                break
+            self._feed(buf)
+        self.fileobj.seek(pos)
+
+    def read(self, size=-1):
+        pos = self.fileobj.tell()
+        if pos > self.fed:
+            self._catch_up(pos)
+        buf = self.fileobj.read(size) if size >= 0 else self.fileobj.read()
+        if pos + len(buf) > self.fed:
+            self._feed(buf[self.fed - pos:])
+        return buf
+
+    def seek(self, pos, whence=0):
+        self.fileobj.seek(pos, whence)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def finish(self):
+        pos = self.fileobj.tell()
+        self.fileobj.seek(0, 2)
+        self._catch_up(self.fileobj.tell())
+        self.fileobj.seek(pos)
 
+    def close(self):
+        self.fileobj.close()
+
+class _HashingWriter(object):
+    """Wraps a file object opened for writing and calculates the SHA-256
+       of everything written to it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.fileobj.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+class _ThreadedWriter(object):
+    """Passes the data written to a file object on to it in a separate
+       thread, which also closes it. Used to run compressors in parallel;
+       zlib, bz2 and hashlib release the GIL while working."""
+
+    def __init__(self, fileobj, backlog=8):
+        import threading
+        import Queue
+
+        self.fileobj = fileobj
+        self.queue = Queue.Queue(backlog)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.fileobj.write(data)
+                except Exception:
+                    self.error = sys.exc_info()
         try:
-            # lzma doesn't immediately return an error
-            # try and read a bit of data to determine if it is a valid xz file
-            fileobj.read(_LZMAProxy.blocksize)
-            fileobj.seek(0)
-            t = cls.taropen(name, mode, fileobj, **kwargs)
-        except IOError:
-            raise tarfile.ReadError("not a xz file")
-        except lzma.error:
-            raise tarfile.ReadError("not a xz file")
-        t._extfileobj = False
-        return t
-
-if not hasattr(tarfile.TarFile, 'xzopen'):
-    tarfile.open = XzTarFile.open
+            self.fileobj.close()
+        except Exception:
+            if self.error is None:
+                self.error = sys.exc_info()
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        self.queue.put(data)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
 
 
 class SetEncoder(json.JSONEncoder):
@@ -274,13 +563,27 @@ class BasicInfo(object):
     #
     # WARNING: When extending this, make sure tarfile.TarFile
     #          actually also supports the new compression!
-    #          See e.g. XzTarFile class
+    #          See e.g. XzTarFile class in xztarfile.py
+    #
+    # Values are the compression names (see MAGIC)
     FORMATS = {
-        'tar.gz': gzip.GzipFile,
-        'tar.bz2': bz2.BZ2File,
-        'tar.xz': lzma.LZMAFile
+        'tar.gz': 'gz',
+        'tar.bz2': 'bz2',
+        'tar.xz': 'xz'
     }
 
+    # Magic bytes which identify the compression of a tarball. Compression
+    # names match the ones in tarfile.TarFile.OPEN_METH ('tar' meaning
+    # uncompressed)
+    MAGIC = [
+        # Compression; offset; magic bytes
+        ('gz', 0, '\x1f\x8b'),
+        ('bz2', 0, 'BZh'),
+        ('xz', 0, '\xfd7zXZ\x00'),
+        ('tar', 257, 'ustar')
+    ]
+    MAGIC_LEN = max([offset + len(magic) for comptype, offset, magic in MAGIC])
+
     DIFF_FILES = [
         # Filename in tarball; extension on ftp.gnome.org; heading name
         ('NEWS', 'news', 'News'),
@@ -289,14 +592,17 @@ class BasicInfo(object):
     DIFF_FILES_DICT = dict([(a,(b,c)) for a,b,c in DIFF_FILES])
 
 class DOAP(BasicInfo):
-    JSONVERSION = 1
+    CACHEVERSION = 1
 
     NS_DOAP = "http://usefulinc.com/ns/doap#"
     #NS_FOAF = "http://xmlns.com/foaf/0.1/"
     NS_GNOME = "http://api.gnome.org/doap-extensions#"
 
     DOAP_URL = 'https://gitlab.gnome.org/repositories.doap'
+    # Parsed DOAP information
     DOAP_CACHE = '/ftp/cache/doap.json'
+    # Seconds the cached information is used without checking DOAP_URL
+    DOAP_TTL = 15 * 60
     GITLAB_REPO = 'ssh://git@gitlab.gnome.org'
 
     TARBALL_PATH_PREFIX = '/sources/'
@@ -304,12 +610,17 @@ class DOAP(BasicInfo):
 
     PROPERTIES = ('description', 'shortdesc', 'name')
     PROPERTIES_AS_LIST = ('bug-database', )
+    # Only these predicates are kept while parsing DOAP_URL
+    PARSED_PROPERTIES = frozenset(
+        [(NS_DOAP, prop) for prop in PROPERTIES + PROPERTIES_AS_LIST
+                                   + ('repository', 'location', 'download-page', 'maintainer')]
+        + [(NS_GNOME, 'userid')])
 
 
     # http://www.artima.com/forums/flat.jsp?forum=122&thread=15024
 
     def __init__(self):
-        self.jsonfile = self.DOAP_CACHE
+        self.cachefile = self.DOAP_CACHE
         self._init_doap()
 
     def get_module(self, tarball):
@@ -332,46 +643,44 @@ class DOAP(BasicInfo):
         changed = False
         etag = None
         last_modified = None
+        info, TARBALL_TO_MODULE, UID_TO_MODULES = {}, {}, {}
 
-        # XXX - unfinished
-        if not os.path.exists(self.jsonfile):
-            force_refresh = True
+        cached, age = (None, None) if force_refresh else self._load_cache()
+        if cached is not None:
+            etag, last_modified, info, TARBALL_TO_MODULE, UID_TO_MODULES = cached
+            if not len(info):
+                cached = None
 
-        if not force_refresh:
-            j = json.load(open(self.jsonfile, 'rb'))
-            json_ver = j[0]
-            if json_ver == self.JSONVERSION:
-                json_ver, etag, last_modified, info, TARBALL_TO_MODULE, UID_TO_MODULES = j
-                if not len(info):
-                    force_refresh=True
-            elif json_ver > self.JSONVERSION:
-                print >>sys.stderr, "ERROR: Json newer than supported version, ignoring json"
-                force_refresh=True
-            else:
-                force_refresh=True
+        # Within the TTL the cached information is used as is
+        if cached is None or not 0 <= age < self.DOAP_TTL:
+            import urllib2
 
-        req = urllib2.Request(self.DOAP_URL)
+            req = urllib2.Request(self.DOAP_URL)
 
-        if not force_refresh:
-            if etag:
-                    req.add_header("If-None-Match", etag)
-            if last_modified:
-                    req.add_header("If-Modified-Since", last_modified)
+            if cached is not None:
+                if etag:
+                        req.add_header("If-None-Match", etag)
+                if last_modified:
+                        req.add_header("If-Modified-Since", last_modified)
 
-        try:
-            # Always need to check if there's any newer information
-            url_handle = urllib2.urlopen(req)
-        except urllib2.HTTPError, e:
-            if e.code == 304:
-                pass
-            elif force_refresh:
-                print >>sys.stderr, "ERROR: Cannot read DOAP file and no old copy available"
+            try:
+                url_handle = urllib2.urlopen(req)
+            except urllib2.HTTPError, e:
+                if e.code == 304:
+                    self._touch_cache()
+                elif cached is None:
+                    print >>sys.stderr, "ERROR: Cannot read DOAP file and no old copy available"
+                else:
+                    print e.code
+                    print >>sys.stderr, "WARNING: Cannot retrieve DOAP file; using old copy"
+            except urllib2.URLError, e:
+                if cached is None:
+                    print >>sys.stderr, "ERROR: Cannot read DOAP file and no old copy available"
+                else:
+                    print >>sys.stderr, "WARNING: Cannot retrieve DOAP file (%s); using old copy" % e.reason
             else:
-                print e.code
-                print >>sys.stderr, "WARNING: Cannot retrieve DOAP file; using old copy"
-        else:
-            etag, last_modified, info, TARBALL_TO_MODULE, UID_TO_MODULES = self._parse_url_handle(url_handle)
-            changed = True
+                etag, last_modified, info, TARBALL_TO_MODULE, UID_TO_MODULES = self._parse_url_handle(url_handle)
+                changed = True
 
         self.etag = etag
         self.last_modified = last_modified
@@ -381,9 +690,40 @@ class DOAP(BasicInfo):
 
         if changed:
             # save the new information
-            self.write_json()
+            self.write_cache()
+
+    def _load_cache(self):
+        """Returns the cached information and its age in seconds
+
+        The age is the time since DOAP_URL was last checked. Returns
+        (None, None) if there is no usable cache."""
+        try:
+            with open(self.cachefile, 'rb') as f:
+                age = time.time() - os.fstat(f.fileno()).st_mtime
+                data = json.load(f)
+        except (EnvironmentError, ValueError):
+            return None, None
+
+        if not isinstance(data, list) or not data or data[0] != self.CACHEVERSION:
+            if isinstance(data, list) and data and data[0] > self.CACHEVERSION:
+                print >>sys.stderr, "ERROR: DOAP cache newer than supported version, ignoring it"
+            return None, None
+        if len(data) != 6 or not all(isinstance(d, dict) for d in data[3:]):
+            return None, None
+
+        return data[1:], age
+
+    def _touch_cache(self):
+        """Marks the cached information as checked"""
+        try:
+            os.utime(self.cachefile, None)
+        except EnvironmentError:
+            pass
 
     def _parse_url_handle(self, url_handle):
+        import urlparse
+        import semi_rdf
+
         UID_TO_MODULES = {}
         TARBALL_TO_MODULE = {}
         MODULE_INFO = {}
@@ -394,11 +734,14 @@ class DOAP(BasicInfo):
         etag = headers.getheader("ETag")
         last_modified = headers.getheader("Last-Modified")
 
-        nodes = semi_rdf.read_rdf(url_handle)
+        # Parse incrementally, only projects are needed. The semi_rdf of
+        # gitadmin-bin might not support this yet.
+        project = (self.NS_DOAP, "Project")
+        if hasattr(semi_rdf, 'iter_rdf'):
+            nodes = semi_rdf.iter_rdf(url_handle, names=(project,), keep=self.PARSED_PROPERTIES)
+        else:
+            nodes = [node for node in semi_rdf.read_rdf(url_handle) if node.name == project]
         for node in nodes:
-            if node.name != (self.NS_DOAP, "Project"):
-                continue
-
             repo = node.find_property((self.NS_DOAP, u'repository'))
             modname = None
             if isinstance(repo, semi_rdf.Node):
@@ -440,28 +783,271 @@ class DOAP(BasicInfo):
             if maints:
                 MODULE_INFO[modname]['maintainers'] = maints
 
+            # Values are stored as plain strings (see write_cache)
             for prop in self.PROPERTIES:
                 val = node.find_property((self.NS_DOAP, prop))
-                if val is not None:  MODULE_INFO[modname][prop] = val
+                if val is not None:  MODULE_INFO[modname][prop] = self._plain(val)
 
             for prop in self.PROPERTIES_AS_LIST:
                 val = node.find_properties((self.NS_DOAP, prop))
-                if val: MODULE_INFO[modname][prop] = list(val)
+                if val: MODULE_INFO[modname][prop] = [self._plain(v) for v in val]
+
+        url_handle.close()
 
         return (etag, last_modified, MODULE_INFO, TARBALL_TO_MODULE, UID_TO_MODULES)
 
-    def write_json(self):
-        # Want to overwrite any existing file and change the owner
-        if os.path.exists(self.jsonfile):
-            os.remove(self.jsonfile)
-        with open(self.jsonfile, 'w') as f:
-            json.dump((self.JSONVERSION, self.etag, self.last_modified, self.info, self.tarball_to_module, self.uid_to_module), f, cls=SetEncoder)
-            if self.GROUPID is not None:
-                os.fchown(f.fileno(), -1, self.GROUPID)
+    @staticmethod
+    def _plain(value):
+        """Converts e.g. a semi_rdf.UrlResource into a plain string"""
+        if isinstance(value, unicode):
+            return unicode(value)
+        if isinstance(value, str):
+            return str(value)
+        return value
+
+    def write_cache(self):
+        # Replace the file atomically, other processes might be reading it
+        import tempfile
+
+        dirname, basename = os.path.split(self.cachefile)
+        fd, tmpname = tempfile.mkstemp(prefix='.%s' % basename, dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                json.dump((self.CACHEVERSION, self.etag, self.last_modified, self.info,
+                           self.tarball_to_module, self.uid_to_module), f, cls=SetEncoder)
+                os.fchmod(f.fileno(), 0664)
+                if self.GROUPID is not None:
+                    os.fchown(f.fileno(), -1, self.GROUPID)
+            os.rename(tmpname, self.cachefile)
+        except:
+            os.remove(tmpname)
+            raise
+
+
+class SqliteStore(BasicInfo):
+    """Base class for information kept in a SQLite database
+
+    The database is opened on first use; subclasses create their tables
+    in _create_tables()."""
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        # Note: a SQLite connection cannot be shared with child processes
+        self.pid = os.getpid()
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            is_new = not os.path.exists(self.dbfile)
+            db = sqlite3.connect(self.dbfile, timeout=60)
+            db.text_factory = str
+            self._set_permissions(is_new)
+
+            with db:
+                self._create_tables(db)
+            self._db = db
+
+        return self._db
+
+    def _set_permissions(self, is_new):
+        """Makes the database writable for the group
+
+        SQLite creates it as 0644 whatever the umask is. Databases created
+        like that earlier are fixed by their owner."""
+        st = os.stat(self.dbfile)
+        if st.st_uid != os.getuid():
+            return
+
+        if st.st_mode & 0664 != 0664:
+            os.chmod(self.dbfile, (st.st_mode & 07777) | 0664)
+        if is_new and self.GROUPID is not None:
+            os.chown(self.dbfile, -1, self.GROUPID)
+
+    # Stored data is JSON, never pickle: the databases are writable for the
+    # whole group. Byte strings are taken as Latin-1 so any bytes survive.
+
+    @staticmethod
+    def _to_json(data):
+        return json.dumps(data, encoding='latin-1', separators=(',', ':'))
+
+    @classmethod
+    def _from_json(cls, text):
+        """Returns the data stored by _to_json, raises ValueError if text
+        is not valid"""
+        return cls._bytes(json.loads(text))
+
+    @classmethod
+    def _bytes(cls, obj):
+        if isinstance(obj, unicode):
+            return obj.encode('latin-1')
+        if isinstance(obj, list):
+            return [v.encode('latin-1') if isinstance(v, unicode) else cls._bytes(v) for v in obj]
+        if isinstance(obj, dict):
+            return dict((k.encode('latin-1'), cls._bytes(v)) for k, v in obj.iteritems())
+        return obj
+
+
+class CheckCache(SqliteStore):
+    """Persistent cache of TarInfo.check() results
+
+    Results are keyed on the path and only used while the size,
+    modification time and inode (and optionally the SHA-256) of the file
+    are unchanged."""
+    CACHEVERSION = 2
+    CHECK_CACHE = '/ftp/cache/tarinfo.sqlite'
+
+    # Also compare the SHA-256 of the file (reads the file, but does not
+    # decompress it)
+    USE_SHA256 = False
+
+    _instance = None
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None or cls._instance.pid != os.getpid():
+            cls._instance = cls(cls.CHECK_CACHE)
+
+        return cls._instance
+
+    def _create_tables(self, db):
+        db.execute('CREATE TABLE IF NOT EXISTS checks (path TEXT PRIMARY KEY, version INTEGER, '
+                   'size INTEGER, mtime REAL, inode INTEGER, sha256 TEXT, data BLOB)')
+
+    def _identity(self, path):
+        stat = os.stat(path)
+        sha256 = None
+        if self.USE_SHA256:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for buf in iter(lambda: f.read(self.BLOCKSIZE), ''):
+                    h.update(buf)
+            sha256 = h.hexdigest()
+
+        return (stat.st_size, stat.st_mtime, stat.st_ino, sha256)
+
+    def load(self, path):
+        """Returns the identity of the file and the cached results (None if
+        the results are unknown or outdated)"""
+        identity = self._identity(path)
+        try:
+            row = self.db.execute('SELECT version, size, mtime, inode, sha256, data FROM checks WHERE path = ?',
+                                  (path,)).fetchone()
+        except sqlite3.Error:
+            return identity, None
+
+        if row is None or row[0] != self.CACHEVERSION or tuple(row[1:5]) != identity:
+            return identity, None
+
+        # Anything which cannot be decoded is a cache miss
+        try:
+            data = self._from_json(zlib.decompress(row[5]))
+            data['files'] = set(data['files'])
+            if not isinstance(data['file'], dict) or not isinstance(data['errors'], dict):
+                return identity, None
+        except (ValueError, TypeError, KeyError, zlib.error):
+            return identity, None
+
+        return identity, data
+
+    def store(self, path, identity, data):
+        data = dict(data, files=sorted(data['files']))
+        blob = sqlite3.Binary(zlib.compress(self._to_json(data)))
+        try:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (path, self.CACHEVERSION) + identity + (blob,))
+        except sqlite3.Error:
+            # The cache is an optimization only
+            pass
+
+
+class NewsStore(SqliteStore):
+    """Contents of the DIFF_FILES (NEWS, ChangeLog) of valid tarballs
+
+    Stored per module version, compressed and deduplicated on their
+    SHA-256, so generating news does not need to open older tarballs.
+    The contents are only used for the tarball they were read from (same
+    size, modification time and inode, see TarInfo.identity); e.g. a
+    rejected upload of the same version must not replace them."""
+    STOREVERSION = 2
+    NEWS_STORE = '/ftp/cache/news.sqlite'
+
+    _instance = None
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None or cls._instance.pid != os.getpid():
+            cls._instance = cls(cls.NEWS_STORE)
+
+        return cls._instance
+
+    def _create_tables(self, db):
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or int(row[0]) != self.STOREVERSION:
+            db.execute('DROP TABLE IF EXISTS files')
+            db.execute('DROP TABLE IF EXISTS contents')
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(self.STOREVERSION),))
+        db.execute('CREATE TABLE IF NOT EXISTS contents (sha256 TEXT PRIMARY KEY, data BLOB)')
+        # sha256 is NULL if the tarball does not contain the file
+        db.execute('CREATE TABLE IF NOT EXISTS files (module TEXT, version TEXT, name TEXT, '
+                   'size INTEGER, mtime REAL, inode INTEGER, sha256 TEXT, '
+                   'PRIMARY KEY (module, version, name))')
+
+    def load(self, module, version, identity):
+        """Returns a dict with the lines of each file, None if the version
+        is unknown or was stored for another tarball"""
+        try:
+            rows = self.db.execute('SELECT files.name, size, mtime, inode, contents.data FROM files '
+                                   'LEFT JOIN contents ON files.sha256 = contents.sha256 '
+                                   'WHERE module = ? AND version = ?', (module, version)).fetchall()
+        except sqlite3.Error:
+            return None
+
+        if not rows:
+            return None
+
+        files = {}
+        for name, size, mtime, inode, data in rows:
+            if (size, mtime, inode) != identity:
+                return None
+            if data is not None:
+                try:
+                    lines = self._from_json(zlib.decompress(data))
+                except (ValueError, zlib.error):
+                    return None
+                if not isinstance(lines, list):
+                    return None
+                files[name] = lines
+        return files
+
+    def store(self, module, version, identity, files):
+        """Store the files (dict with lines of each file in DIFF_FILES)"""
+        try:
+            with self.db:
+                for name, heading, formatname in self.DIFF_FILES:
+                    sha256 = None
+                    if name in files:
+                        # Keep the exact lines as read from the tarball
+                        data = self._to_json(files[name])
+                        sha256 = hashlib.sha256(data).hexdigest()
+                        self.db.execute('INSERT OR REPLACE INTO contents VALUES (?, ?)',
+                                        (sha256, sqlite3.Binary(zlib.compress(data, 9))))
+                    self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (module, version, name) + identity + (sha256,))
+        except sqlite3.Error:
+            # The store is an optimization only
+            pass
 
 
 class TarInfo(BasicInfo):
 
+    # Use the results of previous checks (see CheckCache)
+    USE_CACHE = True
+
+    CHECK_ATTRS = ('size_files', 'file_count', 'tar_end_of_data_pos', 'tar_end_of_file_pos', 'uniq_dir')
+
     def __init__(self, path, files=set()):
         self.path = path
         self.file = {}
@@ -489,20 +1075,82 @@ class TarInfo(BasicInfo):
 
         self.files = tarinfo_files
 
-    def check(self, progress=False):
-        """Check tarball consistency"""
+    def compression(self):
+        """Determine the compression by looking at the magic bytes
+
+        Returns None if the compression is not recognized"""
+        with open(self.path, 'rb') as f:
+            header = f.read(self.MAGIC_LEN)
+
+        for comptype, offset, magic in self.MAGIC:
+            if header[offset:offset + len(magic)] == magic:
+                return comptype
+
+        return None
+
+    def identity(self):
+        """Returns the size, modification time and inode of the file"""
+        st = os.stat(self.path)
+        return (st.st_size, st.st_mtime, st.st_ino)
+
+    def check(self, progress=False, cached=None, raw_sinks=(), data_sinks=()):
+        """Check tarball consistency
+
+        Unless cached is False (default: USE_CACHE), the results of a
+        previous check of the unchanged file are used.
+
+        The raw_sinks and data_sinks are called with all of the file's
+        compressed respectively decompressed data (see _TeeReader); this
+        implies cached=False."""
         if hasattr(self, '_errors'):
             return self._errors
 
+        if cached is None:
+            cached = self.USE_CACHE
+        if raw_sinks or data_sinks:
+            cached = False
+
+        if cached:
+            cache = CheckCache.get()
+            realpath = os.path.realpath(self.path)
+            try:
+                identity, data = cache.load(realpath)
+            except EnvironmentError:
+                # Let the check report the problem
+                cached = False
+                data = None
+            # Only usable if it contains all the files we need
+            if data is not None and self.files <= data['files']:
+                for attr in self.CHECK_ATTRS:
+                    if attr in data:
+                        setattr(self, attr, data[attr])
+                self.file = data['file']
+                self._errors = data['errors']
+                return self._errors
+
+        import tarfile
+        import xztarfile # for tarfile.open() support of xz
+
         errors = {}
         files = self.files
 
         t = None
+        raw = None
         try:
-            # This automatically determines the compression method
-            # However, it does that by just trying to open it with every compression method it knows
-            # and seeing what succeeds. Which is somewhat inefficient
-            t = tarfile.open(self.path, 'r')
+            # Open the tarball directly with the compression method the
+            # magic bytes indicate. Unrecognized files are most likely old
+            # (pre-POSIX) tarballs, so treat them as uncompressed.
+            comptype = self.compression() or 'tar'
+            if raw_sinks and comptype != 'xz':
+                raw = _TeeReader(open(self.path, 'rb'), raw_sinks, self.BLOCKSIZE)
+                t = tarfile.open(self.path, 'r:%s' % comptype, fileobj=raw)
+            else:
+                t = tarfile.open(self.path, 'r:%s' % comptype)
+
+            # Read everything through one forward-only stream, this ensures
+            # the data is only decompressed once
+            stream = _ForwardReader(t.fileobj, self.BLOCKSIZE, data_sinks)
+            t.fileobj = stream
 
             size_files = 0
             file_count = 0
@@ -530,14 +1178,20 @@ class TarInfo(BasicInfo):
                         dots_shown = dots_to_show
 
             # Now determine the current position in the tar file
-            tar_end_of_data_pos = t.fileobj.tell()
+            tar_end_of_data_pos = stream.tell()
             # as well as the last position in the tar file
             # Note: doing a read as seeking is often not supported :-(
-            while t.fileobj.read(self.BLOCKSIZE) != '':
+            while stream.skip(self.BLOCKSIZE):
                 if progress:
                     sys.stdout.write(".")
-            tar_end_of_file_pos = t.fileobj.tell()
-
+            tar_end_of_file_pos = stream.tell()
+            if raw is not None:
+                raw.finish()
+            elif raw_sinks:
+                # Opened by name, so xztarfile can decompress multi-block
+                # files in parallel; the raw data is read separately
+                with open(self.path, 'rb') as f:
+                    _TeeReader(f, raw_sinks, self.BLOCKSIZE).finish()
 
             test_uniq_dir = '%s-%s/' % (self.module, self.version)
             if uniq_dir is None:
@@ -550,7 +1204,7 @@ class TarInfo(BasicInfo):
             # if test_eof_data > MAX_EXTRA_DATA:
             #     errors['EXTRA_DATA'] = 'Too much uncompressed tarball data (expected max %s, found %s); use tar-ustar in AM_INIT_AUTOMAKE!' % (human_size(MAX_EXTRA_DATA), human_size(test_eof_data))
 
-            if not isinstance(t.fileobj, self.FORMATS.get(self.format, "")):
+            if self.format != ('tar.%s' % comptype if comptype != 'tar' else 'tar'):
                 errors['WRONG_EXT'] = 'Compression used is different than what extension suggests'
 
             self.size_files = size_files
@@ -563,10 +1217,51 @@ class TarInfo(BasicInfo):
         finally:
             if t:
                 t.close()
+            if raw is not None:
+                raw.close()
 
         self._errors = errors
+
+        if not errors and self.module is not None:
+            try:
+                NewsStore.get().store(self.module, self.version, self.identity(), self.file)
+            except EnvironmentError:
+                # Removed meanwhile
+                pass
+
+        if cached:
+            data = {
+                'errors': errors,
+                'files': files,
+                'file': self.file
+            }
+            for attr in self.CHECK_ATTRS:
+                if hasattr(self, attr):
+                    data[attr] = getattr(self, attr)
+            cache.store(realpath, identity, data)
+
         return self._errors
 
+    def load_files(self, progress=False):
+        """Makes the DIFF_FILES in the tarball available in self.file
+
+        Uses the NewsStore if possible, otherwise the tarball is checked.
+        Returns the errors of the check."""
+        if self.USE_CACHE and not hasattr(self, '_errors') and self.module is not None:
+            diff_files = set(['%s-%s/%s' % (self.module, self.version, tarballname)
+                              for tarballname, format, formatname in self.DIFF_FILES])
+            if self.files <= diff_files:
+                try:
+                    files = NewsStore.get().load(self.module, self.version, self.identity())
+                except EnvironmentError:
+                    # Let the check report the problem
+                    files = None
+                if files is not None:
+                    self.file = files
+                    return {}
+
+        return self.check(progress)
+
     def diff(self, files, prev_tarinfo, constructor, progress=False):
         diffs = {}
         prev_errors = False
@@ -579,7 +1274,7 @@ class TarInfo(BasicInfo):
         if prev_tarinfo:
             if progress:
                 sys.stdout.write(" - Checking previous tarball: ")
-            prev_errors = prev_tarinfo.check(progress)
+            prev_errors = prev_tarinfo.load_files(progress)
             if not prev_errors:
                 if progress:
                     print ", done"
@@ -596,20 +1291,14 @@ class TarInfo(BasicInfo):
 
             f = constructor(fn)
             if prev_tarinfo is not None and fn in prev_tarinfo.file:
-                context = 0
                 a = prev_tarinfo.file[fn]
                 b = self.file[fn]
-                break_for = False
                 lines = 0
-                for group in difflib.SequenceMatcher(None,a,b).get_grouped_opcodes(context):
-                    i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
-                    for tag, i1, i2, j1, j2 in group:
-                        if tag == 'replace' or tag == 'insert':
-                            lines += j2 - j1
-                            f.writelines(b[j1:j2])
-                            break_for = True
-                    if break_for:
-                        break
+                head = news_head(a, b)
+                if head is not None:
+                    j1, j2 = head
+                    lines = j2 - j1
+                    f.writelines(b[j1:j2])
                 if lines > 2:
                     f.flush()
                     diffs[fn] = f
@@ -634,7 +1323,13 @@ class TarInfo(BasicInfo):
 
 
 class DirectoryInfo(BasicInfo):
-    JSONVERSION = 4
+    JSONVERSION = 5
+
+    # Instances kept in memory, by directory and module. Only used by the
+    # daemon, which keeps them up to date (see update).
+    _memory = None
+    # Modules whose versions have to be sorted again after an update
+    _outdated = None
 
     def __init__(self, relpath, limit_module=None):
         self.relpath = relpath
@@ -644,21 +1339,41 @@ class DirectoryInfo(BasicInfo):
         self.read_json()
 
     def refresh(self):
-        self.read_json(force_refresh=True)
+        self.read_json(rescan=True)
+
+    def read_json(self, force_refresh=False, rescan=False):
+        """Read the information about the files in the directory tree
+
+        If force_refresh is set, the whole tree is scanned. If rescan is set,
+        only the directories which changed since they were last scanned are
+        scanned again."""
+        memory = DirectoryInfo._memory
+        if memory is not None and not force_refresh:
+            known = memory.get(os.path.dirname(self.jsonfile), {}).get(self.module)
+            if known is not None and not rescan:
+                if known._outdated:
+                    known._update_versions(known._outdated)
+                    known._outdated = None
+                self._info, self._ignored, self._dirs, self._versions = \
+                        known._info, known._ignored, known._dirs, known._versions
+                return
+            # Anything not in memory might have changed since it was stored
+            rescan = True
 
-    def read_json(self, force_refresh=False):
         info = {}
         ignored = {}
+        # Per directory: modification time and inode at the time it was scanned
+        dirs = {}
         changed = False
 
-        if not os.path.exists(self.jsonfile):
+        j = self._load_json() if not force_refresh else None
+        if j is None:
             force_refresh = True
 
         if not force_refresh:
-            j = json.load(open(self.jsonfile, 'rb'))
             json_ver = j[0]
             if json_ver == self.JSONVERSION:
-                json_ver, info, json_versions, ignored = j
+                json_ver, info, json_versions, ignored, dirs = j
                 if not len(info):
                     force_refresh=True
             elif json_ver > self.JSONVERSION:
@@ -669,54 +1384,213 @@ class DirectoryInfo(BasicInfo):
 
         absdir = os.path.join(self.FTPROOT, self.relpath)
         if force_refresh and os.path.exists(absdir):
-            curdir = os.getcwd()
-            try:
-                # Ensures paths are relative to the moduledir
-                os.chdir(absdir)
-                for root, dirs, files in os.walk(".", topdown=False):
-                    saneroot = root[2:] if root.startswith("./") else root
-                    for filename in files:
-                        r = re_file.match(filename)
-                        if r:
-                            changed = True
-
-                            fileinfo = r.groupdict()
-                            module = fileinfo['module']
-                            version = fileinfo['version']
-                            format = fileinfo['format']
-
-                            if module not in info:
-                                info[module] = {}
-
-                            if version not in info[module]:
-                                info[module][version] = {}
-
-                            if self.module is None or module == self.module:
-                                info[module][version][format] = os.path.join(saneroot, filename)
-                                continue
-
-                        # If we arrive here, it means we ignored the file for some reason
-                        if saneroot not in ignored:
-                            ignored[saneroot] = []
-                        ignored[saneroot].append(filename)
-            finally:
-                os.chdir(curdir)
+            info = {}
+            ignored = {}
+            dirs = {}
+            changed = len(self._scan_dirs(absdir, ['.'], info, ignored, dirs)) > 0
+        elif rescan and os.path.exists(absdir):
+            todo = []
+            removed = []
+            for saneroot in dirs.keys():
+                try:
+                    stat = os.stat(os.path.join(absdir, saneroot))
+                except OSError:
+                    stat = None
+
+                if stat is not None and [stat.st_mtime, stat.st_ino] == dirs[saneroot]:
+                    continue
+
+                removed.extend(self._forget_dir(info, ignored, saneroot))
+                del dirs[saneroot]
+                if stat is not None:
+                    todo.append(saneroot)
+                else:
+                    changed = True
+
+            added = self._scan_dirs(absdir, todo, info, ignored, dirs)
+            # Note: writing cache.json changes the directory it is in, so only
+            #       write it if the contents actually changed
+            if sorted(added) != sorted(removed):
+                changed = True
 
         # XXX - maybe remove versions which lack tar.*
 
         self._info = info
-        versions = {}
-        if self.module:
-            versions[self.module] = []
-        for module in info.keys():
-            versions[module] = sorted(info[module], version_cmp)
-        self._versions = versions
         self._ignored = ignored
+        self._dirs = dirs
+        self._update_versions()
 
         if changed:
             # save the new information
             self.write_json()
 
+        if memory is not None:
+            memory.setdefault(os.path.dirname(self.jsonfile), {})[self.module] = self
+
+    def _update_versions(self, modules=None):
+        """Update the sorted list of versions for the given (or all) modules"""
+        if modules is None:
+            versions = {}
+            if self.module:
+                versions[self.module] = []
+            modules = self._info.keys()
+            self._versions = versions
+        for module in modules:
+            if module in self._info:
+                self._versions[module] = sorted(self._info[module], key=version_key)
+            elif module == self.module:
+                self._versions[module] = []
+            else:
+                self._versions.pop(module, None)
+
+    def _scan_dirs(self, absdir, todo, info, ignored, dirs):
+        """Scan the given directories (relative to absdir), as well as any
+        subdirectories which were not scanned before
+
+        Returns the paths of the files which were found"""
+        found = []
+        seen = set(todo)
+        todo = list(todo)
+        while todo:
+            saneroot = todo.pop()
+            path = os.path.join(absdir, saneroot)
+            try:
+                # Note: stat before listing, a change while listing will be
+                # noticed on the next rescan
+                stat = os.stat(path)
+                filenames = os.listdir(path)
+            except OSError:
+                continue
+            dirs[saneroot] = [stat.st_mtime, stat.st_ino]
+
+            for filename in filenames:
+                if os.path.isdir(os.path.join(path, filename)):
+                    # Like os.walk, do not follow symlinks to directories
+                    subdir = filename if saneroot == '.' else os.path.join(saneroot, filename)
+                    if subdir not in dirs and subdir not in seen \
+                       and not os.path.islink(os.path.join(path, filename)):
+                        seen.add(subdir)
+                        todo.append(subdir)
+                    continue
+
+                self._add_file(info, ignored, saneroot, filename)
+                found.append(os.path.join(saneroot, filename))
+
+        return found
+
+    def _add_file(self, info, ignored, saneroot, filename):
+        """Add a file found in directory saneroot
+
+        Returns True if the file was recognized"""
+        r = re_file.match(filename)
+        if r:
+            fileinfo = r.groupdict()
+            module = fileinfo['module']
+            version = fileinfo['version']
+            format = fileinfo['format']
+
+            if module not in info:
+                info[module] = {}
+
+            if version not in info[module]:
+                info[module][version] = {}
+
+            if self.module is None or module == self.module:
+                info[module][version][format] = os.path.join(saneroot, filename)
+                return True
+
+        # If we arrive here, it means we ignored the file for some reason
+        if saneroot not in ignored:
+            ignored[saneroot] = []
+        ignored[saneroot].append(filename)
+        return r is not None
+
+    def _forget_dir(self, info, ignored, saneroot):
+        """Remove all files in directory saneroot from the information
+
+        Returns the paths of the files which were removed"""
+        removed = [os.path.join(saneroot, filename) for filename in ignored.pop(saneroot, [])]
+
+        for module in info.keys():
+            versions = info[module]
+            found = False
+            for version in versions.keys():
+                formats = versions[version]
+                for format, relpath in formats.items():
+                    if relpath.rpartition('/')[0] == saneroot:
+                        removed.append(relpath)
+                        del formats[format]
+                        if not formats:
+                            del versions[version]
+                        found = True
+            if found and not versions:
+                del info[module]
+
+        return removed
+
+    def _remove_file(self, info, ignored, saneroot, filename):
+        """Remove a file in directory saneroot, the opposite of _add_file
+
+        Returns True if the file was recognized"""
+        r = re_file.match(filename)
+        if r:
+            fileinfo = r.groupdict()
+            module = fileinfo['module']
+            version = fileinfo['version']
+            format = fileinfo['format']
+
+            formats = info.get(module, {}).get(version, {})
+            if formats.get(format) == os.path.join(saneroot, filename):
+                del formats[format]
+                if not formats:
+                    del info[module][version]
+                    if not info[module]:
+                        del info[module]
+                return True
+
+        if filename in ignored.get(saneroot, ()):
+            ignored[saneroot].remove(filename)
+            if not ignored[saneroot]:
+                del ignored[saneroot]
+        return r is not None
+
+    def update(self, path, name, isdir, added):
+        """Apply a change reported by inotify without rescanning
+
+        The file or directory name in directory path (absolute, within this
+        tree) was added or removed."""
+        absdir = os.path.join(self.FTPROOT, self.relpath)
+        saneroot = os.path.relpath(path, absdir)
+        info, ignored, dirs = self._info, self._ignored, self._dirs
+        if saneroot not in dirs:
+            # Reported after the directory was removed
+            return
+
+        if not isdir:
+            # Events can be reported for files found while scanning a new
+            # directory, so always remove first
+            self._remove_file(info, ignored, saneroot, name)
+            if added:
+                self._add_file(info, ignored, saneroot, name)
+            changed = [name]
+        else:
+            subdir = name if saneroot == '.' else os.path.join(saneroot, name)
+            changed = []
+            for saneroot in dirs.keys():
+                if saneroot == subdir or saneroot.startswith(subdir + os.sep):
+                    changed.extend(self._forget_dir(info, ignored, saneroot))
+                    del dirs[saneroot]
+            if added:
+                changed.extend(self._scan_dirs(absdir, [subdir], info, ignored, dirs))
+
+        # Sorting is left until the versions are needed
+        for relpath in changed:
+            r = re_file.match(os.path.basename(relpath))
+            if r:
+                if self._outdated is None:
+                    self._outdated = set()
+                self._outdated.add(r.group('module'))
+
     def determine_file(self, module, version, format, fuzzy=True, relative=False):
         """Determine file using version and format
 
@@ -756,11 +1630,21 @@ class DirectoryInfo(BasicInfo):
         return (relpath, realpath, human_size(stat.st_size), stat)
 
     def write_json(self):
+        self._store_json((self.JSONVERSION, self._info, self._versions, self._ignored, self._dirs))
+
+    def _load_json(self):
+        """Returns the cached information, None if there is none"""
+        if not os.path.exists(self.jsonfile):
+            return None
+
+        return json.load(open(self.jsonfile, 'rb'))
+
+    def _store_json(self, data):
         # Want to overwrite any existing file and change the owner
         if os.path.exists(self.jsonfile):
             os.remove(self.jsonfile)
         with open(self.jsonfile, 'w') as f:
-            json.dump((self.JSONVERSION, self._info, self._versions, self._ignored), f)
+            json.dump(data, f)
             if self.GROUPID is not None:
                 os.fchown(f.fileno(), -1, self.GROUPID)
 
@@ -777,6 +1661,57 @@ class DirectoryInfo(BasicInfo):
         return self._ignored
 
 
+class SectionIndex(SqliteStore):
+    """Cached information of all modules within a section
+
+    Stored in one SQLite database per section, so commands going over all
+    modules only need to open one file. Each module is stored as one row
+    containing the same data as a DirectoryInfo cache.json."""
+    INDEXVERSION = 1
+
+    # One instance per section
+    _indexes = {}
+
+    @classmethod
+    def get(cls, section):
+        if section not in cls._indexes or cls._indexes[section].pid != os.getpid():
+            cls._indexes[section] = cls(os.path.join(cls.FTPROOT, section, 'cache.sqlite'))
+
+        return cls._indexes[section]
+
+    def _create_tables(self, db):
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or int(row[0]) != self.INDEXVERSION:
+            if row is not None and int(row[0]) > self.INDEXVERSION:
+                print >>sys.stderr, "ERROR: Index newer than supported version, recreating index"
+            db.execute('DROP TABLE IF EXISTS modules')
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(self.INDEXVERSION),))
+        db.execute('CREATE TABLE IF NOT EXISTS modules (module TEXT PRIMARY KEY, data TEXT NOT NULL)')
+
+    def load(self, module):
+        """Returns the stored information of a module, None if unknown or
+        if the index cannot be read (the directory is scanned instead)"""
+        try:
+            row = self.db.execute('SELECT data FROM modules WHERE module = ?', (module,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def store(self, module, data):
+        # Replaced within a transaction, so readers see the old or new data
+        try:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO modules VALUES (?, ?)', (module, json.dumps(data)))
+        except sqlite3.Error, e:
+            # The index is an optimization only, e.g. an install must not
+            # fail because it is not writable
+            print >>sys.stderr, "WARNING: Cannot update %s: %s" % (self.dbfile, e)
+
+
 class SuiteInfo(DirectoryInfo):
 
     def __init__(self, suite, version):
@@ -784,7 +1719,7 @@ class SuiteInfo(DirectoryInfo):
         relpath = os.path.join(suite, majmin, version)
         DirectoryInfo.__init__(self, relpath)
 
-    def diff(self, oldversion, obj=sys.stdout):
+    def diff(self, oldversion, obj=sys.stdout, pool=None):
         # XXX  -- assert self.suite == oldversion.suite
         import textwrap
 
@@ -811,12 +1746,8 @@ class SuiteInfo(DirectoryInfo):
 
         news = {}
         sameversions = set()
-        header = "The following modules have a new version"
-        did_header = False
-        have_no_news = False
-        have_errors = False
+        changed = []
         for module in sorted(samemodules):
-            show_contents = True
             newmodulever = self.versions.get(module, (None,))[-1]
             new_file = self.determine_file(module, newmodulever, 'tar') if newmodulever else None
 
@@ -830,29 +1761,34 @@ class SuiteInfo(DirectoryInfo):
                 sameversions.add(module)
                 continue
 
+            changed.append((module, prevmodulever, newmodulever, new_file, prev_file))
+
+        # The tarballs are checked and diffed in the pool (if any), the
+        # output is written in order as the results arrive
+        args = [(new_file, prev_file) for module, prevmodulever, newmodulever, new_file, prev_file in changed]
+        if pool is not None:
+            results = pool.imap(_module_news, args)
+        else:
+            results = itertools.imap(_module_news, args)
+
+        header = "The following modules have a new version"
+        did_header = False
+        have_no_news = False
+        have_errors = False
+        for module, prevmodulever, newmodulever, new_file, prev_file in changed:
             if not did_header:
                 print >>obj, "%s:" % header
                 did_header=True
             obj.write(" - %s (%s => %s)" % (module, prevmodulever or '-none-', newmodulever or '-none'))
 
-
-            fn = 'NEWS'
-
-            new_tarinfo = TarInfo(new_file)
-            new_errors = new_tarinfo.check()
-            if new_errors:
+            errors, text = results.next()
+            if errors:
                 have_errors=True
                 print >>obj, " (E)"
                 continue
 
-            prev_tarinfo = TarInfo(prev_file) if prev_file else None
-
-            constructor = lambda fn: StringIO()
-            diffs = new_tarinfo.diff((fn, ), prev_tarinfo, constructor, progress=False)
-
-            if fn in diffs:
-                news[module] = diffs[fn]
-                news[module].seek(0)
+            if text is not None:
+                news[module] = text
             else:
                 have_no_news=True
                 obj.write(" (*)")
@@ -872,7 +1808,7 @@ class SuiteInfo(DirectoryInfo):
             print >>obj, "  %s" % module
             print >>obj, "========================================"
             print >>obj, ""
-            print >>obj, news[module].read()
+            print >>obj, news[module]
 
 
 class ModuleInfo(DirectoryInfo):
@@ -884,12 +1820,20 @@ class ModuleInfo(DirectoryInfo):
         relpath = os.path.join(self.section, self.module)
         DirectoryInfo.__init__(self, relpath, limit_module=module)
 
+    def _load_json(self):
+        return SectionIndex.get(self.section).load(self.module)
+
+    def _store_json(self, data):
+        SectionIndex.get(self.section).store(self.module, data)
+
     def _set_doap(self):
         # Determine maintainers and module name
 
         # single instance
-        doap = DOAP()
-        self.__class__._doap = doap
+        doap = getattr(self.__class__, '_doap', None)
+        if doap is None:
+            doap = DOAP()
+            self.__class__._doap = doap
 
         # get_from_doap relies on self._reponame being set
         self._reponame = doap.get_module(self.module)
@@ -897,10 +1841,15 @@ class ModuleInfo(DirectoryInfo):
         # Limit maintainers to anyone being a member of GROUP_VCS
         maints = set(self.get_from_doap('maintainers', []))
         if maints:
-            try:
-                maints = set(grp.getgrnam(self.GROUP_VCS).gr_mem).intersection(maints)
-            except KeyError:
-                maints = set()
+            # single lookup, like the DOAP information
+            members = getattr(self.__class__, '_vcs_members', None)
+            if members is None:
+                try:
+                    members = frozenset(grp.getgrnam(self.GROUP_VCS).gr_mem)
+                except KeyError:
+                    members = frozenset()
+                self.__class__._vcs_members = members
+            maints = members.intersection(maints)
 
         self._maintainers = maints
 
@@ -913,14 +1862,14 @@ class ModuleInfo(DirectoryInfo):
 
     @property
     def reponame(self):
-        if not hasattr(self.__class__, '_doap'):
+        if not hasattr(self, '_reponame'):
             self._set_doap()
 
         return self._reponame
 
     @property
     def doap(self):
-        if not hasattr(self.__class__, '_doap'):
+        if not hasattr(self, '_reponame'):
             self._set_doap()
 
         return self.__class__._doap
@@ -929,6 +1878,8 @@ class ModuleInfo(DirectoryInfo):
         return self.doap.info.get(self._reponame, {}).get(needle, default)
 
     def get_bz_product_from_doap(self):
+        import urlparse
+
         for bz in self.get_from_doap('bug-database', []):
             url = urlparse.urlparse(bz)
             if url.netloc == 'bugzilla.gnome.org':
@@ -952,11 +1903,15 @@ class InstallModule(BasicInfo):
     # Preferred format should appear last
     INSTALL_FORMATS = ('tar.xz',)
 
-    def __init__(self, file, section=DEFAULT_SECTION):
+    # Files are created on the filesystem of FTPROOT, but outside of what
+    # is published (mirrors could copy incomplete files)
+    STAGING_DIR = '/ftp/tmp'
+
+    def __init__(self, file, section=DEFAULT_SECTION, pw=None):
         self.file = file
 
         self.uid = os.getuid()
-        self.pw = pwd.getpwuid(self.uid)
+        self.pw = pw if pw is not None else pwd.getpwuid(self.uid)
         self.who = self.pw.pw_gecos
         self.who = re_who.sub("", self.who)
         if self.who == "":
@@ -1018,7 +1973,15 @@ Install %s? [Y/n]""" % self.module,
         # install the module
         return True
 
-    def validate(self, clobber=False):
+    def validate(self, clobber=False, tmpdir=None):
+        """Validates the upload
+
+        If tmpdir is given, the tarballs to install are created in there
+        while reading the upload (see _open_tarballs)."""
+        return self.check_destination(clobber) and self.check_consistency(tmpdir)
+
+    def check_destination(self, clobber=False):
+        """Checks if the upload can be installed, without reading it"""
         if self.module is None:
             print >>sys.stderr, 'ERROR: Unrecognized module/version/file format. Make sure to follow a sane naming scheme (MAJOR.MINOR.MICRO)'
             return False
@@ -1039,10 +2002,16 @@ Install %s? [Y/n]""" % self.module,
                 return False
 
         # XXX - verify if tarball is being installed by a maintainer
+        return True
 
-        # CHECK FOR CONSISTENCY
+    def check_consistency(self, tmpdir=None):
+        """Checks the contents of the upload, see validate"""
         sys.stdout.write(" - Checking consistency: ")
-        errors = self.fileinfo.check(progress=True)
+        raw_sinks, data_sinks = self._open_tarballs(tmpdir) if tmpdir is not None else ((), ())
+        # Never trust cached results for an upload, the uploader controls
+        # everything the cache is keyed on
+        errors = self.fileinfo.check(progress=True, cached=False,
+                                     raw_sinks=raw_sinks, data_sinks=data_sinks)
         if not errors:
             print ", done"
         else:
@@ -1053,69 +2022,64 @@ Install %s? [Y/n]""" % self.module,
         # True if there are no errors
         return len(errors) == 0
 
-    def install(self, unattended=False, clobber=False):
-        print "Preparing installation of %s:" % self.basename
-        # Validate the file
-        if not self.validate(clobber):
-            return False
-
-
-        tmpdir = tempfile.mkdtemp(prefix='install_module')
-        try:
-            created_files = []
-            # do we have a previous version?
-            prev_file = self.moduleinfo.determine_file(self.prevversion, 'tar') if self.prevversion else None
-            prev_tarinfo = TarInfo(prev_file) if prev_file else None
+    def _open_tarballs(self, tmpdir):
+        """Opens the tarballs to create according to INSTALL_FORMATS
+
+        Returns the sinks for the raw and the decompressed data of the
+        upload. These are fed while validating, so the upload is read only
+        once. Each compressor runs in its own thread."""
+        import xztarfile
+
+        self._tarballs = []
+        raw_sinks = []
+        data_sinks = []
+        for format in self.INSTALL_FORMATS:
+            f = _HashingWriter(self._make_tmp_file(tmpdir, format))
+            if format == self.format:
+                compressor = None
+                raw_sinks.append(f.write)
+            else:
+                compressor = _ThreadedWriter(xztarfile.open_compressor(self.FORMATS[format], f.name, f))
+                data_sinks.append(compressor.write)
+            self._tarballs.append((format, f, compressor))
+        return raw_sinks, data_sinks
 
-            constructor = lambda fn: self._make_tmp_file(tmpdir, self.DIFF_FILES_DICT[fn][0])
-            diffs = self.fileinfo.diff(self.DIFF_FILES_DICT, prev_tarinfo, constructor, progress=True)
+    def install(self, unattended=False, clobber=False, prepared=None, signal=True):
+        """Installs the upload
 
-            for fn, f in diffs.iteritems():
-                created_files.append(f.name)
+        If prepared is given, the upload was validated and the files to
+        install were created already (see InstallBatch). It is a tuple of
+        the staging directory and the result of prepare. If signal is not
+        set the mirrors and library-web are not triggered."""
+        import shutil
 
-            # Create tarball(s) according to INSTALL_FORMATS
-            if self.format in self.INSTALL_FORMATS:
-                sys.stdout.write(" - Copying %s" % self.format)
-                with open(self.file, 'rb') as f1:
-                    with self._make_tmp_file(tmpdir, self.format) as f2:
-                        created_files.append(f2.name)
-                        shutil.copyfileobj(f1, f2)
-                print ", done"
+        print "Preparing installation of %s:" % self.basename
 
-            formats = [format for format in self.INSTALL_FORMATS if format != self.format]
-            if len(formats):
-                if len(formats) == 1:
-                    sys.stdout.write(" - Creating %s from %s: " % (formats[0], self.format))
-                else:
-                    sys.stdout.write(" - Creating tarballs from %s: " % self.format)
-                f2 = []
-                for format in formats:
-                    if len(formats) > 1:
-                        sys.stdout.write("%s " % format)
-                    f = self._make_tmp_file(tmpdir, format, constructor=self.FORMATS[format])
-                    created_files.append(f.name)
-                    f2.append(f)
-
-                f1 = self.FORMATS[self.format](self.file, 'rb')
-                while 1:
-                    buf = f1.read(self.BLOCKSIZE)
-                    if not buf:
-                        break
-                    for fdst in f2:
-                        fdst.write(buf)
-                        sys.stdout.write(".")
-                for fdst in f2:
-                    fdst.close()
-                    f2 = []
-                print ", done"
+        if prepared is None:
+            tmpdir = self._make_staging_dir()
+        else:
+            tmpdir, prepared = prepared
+        try:
+            if not self.check_destination(clobber):
+                # e.g. the same version was installed earlier in the batch
+                return False
 
+            if prepared is None:
+                # Validate the file and create the files to install
+                prepared = self.prepare(tmpdir, self.prev_file)
+                if prepared is None:
+                    return False
 
+            created_files, sha256 = prepared
 
             sys.stdout.write(" - Creating sha256sum")
             with self._make_tmp_file(tmpdir, 'sha256sum') as f:
-                cmd = ['sha256sum', '--']
-                cmd.extend([os.path.basename(fn) for fn in created_files if os.path.isfile(fn)])
-                subprocess.call(cmd, stdout=f, cwd=tmpdir)
+                for fn in created_files:
+                    if not os.path.isfile(fn):
+                        continue
+                    if fn not in sha256:
+                        sha256[fn] = sha256_file(fn)
+                    f.write(sha256sum_line(sha256[fn], os.path.basename(fn)))
                 created_files.append(f.name)
             print ", done"
 
@@ -1133,7 +2097,7 @@ Install %s? [Y/n]""" % self.module,
             sys.stdout.write(' - Moving files: ')
             for fn in created_files:
                 dest = os.path.join(self.destination, os.path.basename(fn))
-                shutil.move(fn, dest)
+                move_file(fn, dest)
                 if self.GROUPID is not None:
                     os.chown(dest, -1, self.GROUPID)
                 sys.stdout.write('.')
@@ -1149,6 +2113,7 @@ Install %s? [Y/n]""" % self.module,
                     break
             print ", done"
         finally:
+            self._stop_compressors()
             # cleanup temporary directory
             shutil.rmtree(tmpdir)
 
@@ -1163,9 +2128,97 @@ Install %s? [Y/n]""" % self.module,
         else:
             print ", ignored (owned by protected group)"
 
-        self.inform()
+        self.inform(signal=signal)
         return True
 
+    def _finish_tarballs(self):
+        """Finishes the tarballs according to INSTALL_FORMATS
+
+        These were written while checking the upload (see _open_tarballs).
+        Returns their filenames and SHA-256 digests."""
+        result = []
+        for format, f, compressor in self._tarballs:
+            if compressor is None:
+                sys.stdout.write(" - Copying %s" % self.format)
+                f.close()
+                result.append((f.name, f.sha256.hexdigest()))
+                print ", done"
+
+        tarballs = [tarball for tarball in self._tarballs if tarball[2] is not None]
+        if len(tarballs):
+            if len(tarballs) == 1:
+                sys.stdout.write(" - Creating %s from %s" % (tarballs[0][0], self.format))
+            else:
+                sys.stdout.write(" - Creating tarballs from %s: " % self.format)
+            for format, f, compressor in tarballs:
+                if len(tarballs) > 1:
+                    sys.stdout.write("%s " % format)
+                compressor.close()
+                f.close()
+                result.append((f.name, f.sha256.hexdigest()))
+            print ", done"
+
+        return result
+
+    @property
+    def prev_file(self):
+        """The tarball of the previous version, the diffs are made against it"""
+        return self.moduleinfo.determine_file(self.prevversion, 'tar') if self.prevversion else None
+
+    def prepare(self, tmpdir, prev_file=None):
+        """Checks the contents of the upload and creates the files to
+        install in tmpdir
+
+        Returns the created files and the SHA-256 digests known for them,
+        None if the upload is not valid."""
+        try:
+            if not self.check_consistency(tmpdir):
+                return None
+
+            created_files = []
+            sha256 = {}
+            prev_tarinfo = TarInfo(prev_file) if prev_file else None
+
+            constructor = lambda fn: self._make_tmp_file(tmpdir, self.DIFF_FILES_DICT[fn][0])
+            diffs = self.fileinfo.diff(self.DIFF_FILES_DICT, prev_tarinfo, constructor, progress=True)
+
+            for fn, f in diffs.iteritems():
+                created_files.append(f.name)
+
+            # The compressors kept running while creating the diffs
+            for fn, digest in self._finish_tarballs():
+                created_files.append(fn)
+                sha256[fn] = digest
+
+            return created_files, sha256
+        finally:
+            self._stop_compressors()
+
+    def _stop_compressors(self):
+        """Stops the compressors and closes the files of tarballs which
+        were not finished"""
+        for format, f, compressor in getattr(self, '_tarballs', []):
+            try:
+                try:
+                    if compressor is not None:
+                        compressor.close()
+                finally:
+                    f.close()
+            except Exception:
+                pass
+
+    def _make_staging_dir(self):
+        """Creates the temporary directory for the files to install
+
+        It is placed in STAGING_DIR if possible, so installing the files
+        only needs a rename."""
+        import tempfile
+
+        try:
+            return tempfile.mkdtemp(prefix='.install_module', dir=self.STAGING_DIR)
+        except EnvironmentError:
+            return tempfile.mkdtemp(prefix='install_module')
+
     def _make_tmp_file(self, tmpdir, format, constructor=open):
         fn = os.path.join(tmpdir, '%s-%s.%s' % (self.module, self.version, format))
         f = constructor(fn, 'w')
@@ -1177,14 +2230,19 @@ Install %s? [Y/n]""" % self.module,
         print >>obj, header
         print >>obj, "=" * len(header)
 
-    def inform(self):
-        """Inform regarding the new release"""
+    def inform(self, signal=True):
+        """Inform regarding the new release
+
+        If signal is not set, library-web and the mirrors are not triggered
+        (see signal)."""
         print "Doing notifications:"
         if self.version not in self.moduleinfo.versions:
             print "ERROR: Cannot find new version?!?"
             return False
 
         import textwrap
+        import string
+        import shutil
 
         sha256sum = {}
         sys.stdout.write(" - Informing ftp-release-list")
@@ -1282,6 +2340,13 @@ Install %s? [Y/n]""" % self.module,
         retcode = self._send_email(mail.read(), subject, to, smtp_to, headers)
         print ", done"
 
+        if signal:
+            self.signal([self])
+
+    def signal(self, modules):
+        """Triggers library-web and the mirrors for the given releases"""
+        import shutil
+
         sys.stdout.write(" - Triggering GNOME library update")
         subject = 'GNOME_GIT library-web'
         to = "gnomeweb@webapps.gnome.org"
@@ -1291,18 +2356,19 @@ Install %s? [Y/n]""" % self.module,
         sys.stdout.write(" - Triggering ftp.gnome.org update")
         cmd = ['/usr/local/bin/signal-ftp-sync']
         if self._call_cmd(cmd):
-            print """
+            for module in modules:
+                print """
 Your tarball will appear in the following location on ftp.gnome.org:
 
   %s
 
 It is important to retain the trailing slash for compatibility with
-broken http clients.""" % "/".join((self.URLROOT, self.section, self.module, self.majmin, ""))
-            realpath = self.moduleinfo.determine_file(self.version, 'sha256sum', fuzzy=False)
-            if realpath is not None:
-                print ""
-                with open(realpath, "r") as f:
-                    shutil.copyfileobj(f, sys.stdout)
+broken http clients.""" % "/".join((module.URLROOT, module.section, module.module, module.majmin, ""))
+                realpath = module.moduleinfo.determine_file(module.version, 'sha256sum', fuzzy=False)
+                if realpath is not None:
+                    print ""
+                    with open(realpath, "r") as f:
+                        shutil.copyfileobj(f, sys.stdout)
 
         print """
 The ftp-release-list email uses information from the modules DOAP file. Make
@@ -1326,6 +2392,7 @@ See https://wiki.gnome.org/MaintainersCorner#doap"""
             print ", ignored (debug mode)"
             return True
 
+        import subprocess
         retcode = subprocess.call(cmd)
         if retcode == 0:
             print ", done"
@@ -1337,6 +2404,11 @@ See https://wiki.gnome.org/MaintainersCorner#doap"""
 
     def _send_email(self, contents, subject, to, smtp_to, headers=None):
         """Send an email"""
+        import subprocess
+        from email.mime.text import MIMEText
+        from email.header import Header
+        from email.utils import formataddr
+
         msg = MIMEText(contents, _charset='utf-8')
         msg['Subject'] = subject
         msg['From'] = formataddr((Header(self.who.decode('utf-8')).encode(), 'install-module@master.gnome.org'))
@@ -1358,12 +2430,170 @@ See https://wiki.gnome.org/MaintainersCorner#doap"""
         return p.wait()
 
 
+class InstallBatch(BasicInfo):
+    """Installs several uploads at once, see cmd_install
+
+    The user, the module information and (through ModuleInfo) the DOAP
+    information are only determined once. All uploads are validated and
+    the files to install are created before the first one is installed,
+    in parallel unless jobs is 1 (0 means one process per CPU). Only the
+    confirmation and the installation itself are done in version order,
+    after which the mirrors and library-web are triggered once."""
+
+    def __init__(self, files, section=DEFAULT_SECTION, jobs=0):
+        self.jobs = jobs
+
+        pw = pwd.getpwuid(os.getuid())
+        moduleinfos = {}
+
+        sys.stdout.write("Gathering information and sorting on version: ")
+        self.modules = []
+        for file in files:
+            module = InstallModule(file, section, pw)
+            if module.module is not None:
+                # Uploads of the same module share the known versions, these
+                # are refreshed after each install
+                if module.module not in moduleinfos:
+                    moduleinfos[module.module] = module.moduleinfo
+                module._moduleinfo = moduleinfos[module.module]
+            self.modules.append(module)
+            sys.stdout.write(".")
+        print ", done"
+        self.modules.sort(key=lambda x: (x.module, version_key(x.version) if x.module else ()))
+
+    def install(self, unattended=False, clobber=False):
+        import shutil
+
+        if len(self.modules) == 1:
+            # Nothing to share, this keeps the compressors running while
+            # the diffs are created
+            installed = [module for module in self.modules if module.install(unattended, clobber)]
+            print ""
+            return installed
+
+        prepared = {}
+        installed = []
+        try:
+            self.prepare(clobber, prepared)
+            self.report(prepared)
+
+            for module in self.modules:
+                if module not in prepared:
+                    continue
+
+                tmpdir, result = prepared.pop(module)
+                prev_upload = self._prev_upload.get(module)
+                if prev_upload is not None and prev_upload not in installed:
+                    # The diffs were made against an upload which was not
+                    # installed, start again using what is in the archive
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+                    del module._prevversion
+                    ok = module.install(unattended, clobber, signal=False)
+                else:
+                    ok = module.install(unattended, clobber, prepared=(tmpdir, result), signal=False)
+                if ok:
+                    installed.append(module)
+                print ""
+
+            if installed:
+                print "Triggering updates for %d release(s):" % len(installed)
+                installed[0].signal(installed)
+                print ""
+        finally:
+            for tmpdir, result in prepared.itervalues():
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        return installed
+
+    def prepare(self, clobber, prepared):
+        """Validates all uploads and creates the files to install, filling
+        prepared as needed by InstallModule.install"""
+        import shutil
+
+        # The destination is checked first, so only uploads which can be
+        # installed are read. Its errors are shown with the other output.
+        candidates = []
+        errors = {}
+        saved = sys.stderr
+        try:
+            for module in self.modules:
+                sys.stderr = errors[module] = _Output()
+                if module.check_destination(clobber):
+                    tmpdir = module._make_staging_dir()
+                    prepared[module] = (tmpdir, None)
+                    candidates.append((module, tmpdir))
+        finally:
+            sys.stderr = saved
+
+        # Uploads are installed in version order, so the previous version
+        # of an upload can be an earlier upload of the batch
+        self._prev_upload = {}
+        uploads = {}
+        args = {}
+        for module, tmpdir in candidates:
+            uploaded = uploads.setdefault(module.module, {})
+            module._prevversion = get_latest_version(itertools.chain(module.moduleinfo.versions, uploaded), module.version)
+            if module._prevversion in uploaded:
+                self._prev_upload[module] = uploaded[module._prevversion]
+                prev_file = self._prev_upload[module].file
+            else:
+                prev_file = module.prev_file
+            uploaded[module.version] = module
+            args[module] = (module.file, module.section, module.pw, tmpdir, prev_file)
+
+        pool = None
+        if self.jobs != 1 and len(candidates) > 1:
+            # The uploads are read and the files to install are created in
+            # the pool, the output of each is written in order as the
+            # results arrive
+            import multiprocessing
+            jobs = self.jobs or multiprocessing.cpu_count()
+            pool = multiprocessing.Pool(min(jobs, len(candidates)), _init_worker)
+            results = pool.imap(_prepare_upload, [args[module] for module, tmpdir in candidates])
+        try:
+            for module in self.modules:
+                print "Preparing %s:" % module.basename
+                sys.stderr.write(errors[module].getvalue())
+                if module in prepared:
+                    tmpdir = prepared[module][0]
+                    if pool is not None:
+                        result, out, err = results.next()
+                        sys.stdout.write(out)
+                        sys.stderr.write(err)
+                    else:
+                        result = module.prepare(tmpdir, args[module][4])
+
+                    if result is None:
+                        del prepared[module]
+                        shutil.rmtree(tmpdir, ignore_errors=True)
+                    else:
+                        prepared[module] = (tmpdir, result)
+                print ""
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def report(self, prepared):
+        """Shows which uploads will be installed"""
+        print "Summary:"
+        for module in self.modules:
+            if module in prepared:
+                print " - %s: ready (previous version: %s)" % (module.basename, module.prevversion or 'N/A')
+            else:
+                print " - %s: FAILED" % module.basename
+        print ""
+
+
 class InstallSuites(BasicInfo):
 
     INSTALL_FORMATS = ('tar.gz', 'tar.bz2')
 
+    # Threads used for hashing the tarballs of the suites
+    HASH_THREADS = 4
+
     def __init__(self, file, gnomever):
         self.file = file
+        self._sha256sums = {}
 
         self.suites = {}
         self.moduleinfo = {}
@@ -1438,7 +2668,12 @@ class InstallSuites(BasicInfo):
 
         return is_valid
 
-    def install(self, unattended=False):
+    def install(self, unattended=False, verify=False):
+        """Creates the suites
+
+        The checksums of the tarballs are taken from the sha256sum files of
+        the modules where possible. With verify, all tarballs are hashed and
+        compared against those."""
         # Validate the file
         if not self.validate():
             return False
@@ -1448,13 +2683,14 @@ class InstallSuites(BasicInfo):
 
         for suite in sorted(suites):
             sha256 = {}
+            digests = {}
             sys.stdout.write(" - Linking %s tarballs: " % suite)
             majmin = re_majmin.sub(r'\1', self.version)
             relpath = os.path.join(suite, majmin, self.version, 'sources')
 
             for module in sorted(suites[suite]):
                 data = suites[suite][module]
-                data.sort(lambda a, b: version_cmp(a[0], b[0]) or cmp(a[1], b[1]))
+                data.sort(key=lambda d: (version_key(d[0]), d[1]))
                 for version, subdir in data:
                     relpath2 = relpath if subdir == '' else os.path.join(relpath, subdir)
                     abspath = os.path.join(self.FTPROOT, relpath2)
@@ -1477,6 +2713,10 @@ class InstallSuites(BasicInfo):
                         else:
                             sha256[ext].append(os.path.join(subdir, basename))
 
+                        digest = self._installed_sha256(module, version, os.path.join(self.FTPROOT, relfile))
+                        if digest is not None:
+                            digests[sha256[ext][-1]] = digest
+
                         relfile = os.path.sep.join((['..'] * len(relpath2.split(os.path.sep))) + [relfile])
 
 
@@ -1486,13 +2726,484 @@ class InstallSuites(BasicInfo):
 
             if os.path.exists(os.path.join(self.FTPROOT, relpath)) and sha256:
                 sys.stdout.write(" - Generating sha256sums: ")
+                # Only hash what was not already hashed when installing
+                todo = [fn for files in sha256.itervalues() for fn in files if verify or fn not in digests]
+                paths = [os.path.join(self.FTPROOT, relpath, fn) for fn in todo]
+                mismatches = []
+                for fn, digest in zip(todo, sha256_files(paths, self.HASH_THREADS)):
+                    if digests.get(fn, digest) != digest:
+                        mismatches.append(fn)
+                    digests[fn] = digest
                 for ext, files in sha256.iteritems():
                     sys.stdout.write("%s " % ext)
-                    cmd = ['sha256sum', '--']
-                    cmd.extend(files)
                     with open(os.path.join(self.FTPROOT, relpath, 'SHA256SUMS-for-%s' % ext), 'w') as f:
-                        subprocess.call(cmd, stdout=f, cwd=os.path.join(self.FTPROOT, relpath))
+                        for fn in files:
+                            f.write(sha256sum_line(digests[fn], fn))
                 print ""
+                for fn in mismatches:
+                    print "ERROR: %s does not match the sha256sum file of its module" % fn
+
+    def _installed_sha256(self, module, version, realfile):
+        """Returns the digest of a tarball as recorded in the sha256sum file
+        created when installing it, None if unknown or possibly outdated"""
+        sumfile = self.moduleinfo[module].determine_file(version, 'sha256sum', fuzzy=False)
+        if sumfile is None:
+            return None
+
+        if sumfile not in self._sha256sums:
+            try:
+                self._sha256sums[sumfile] = (os.stat(sumfile).st_mtime, read_sha256sum(sumfile))
+            except EnvironmentError:
+                self._sha256sums[sumfile] = (None, {})
+        mtime, digests = self._sha256sums[sumfile]
+
+        basename = os.path.basename(realfile)
+        try:
+            # Ignore tarballs replaced after the sha256sum file was written
+            if basename not in digests or os.stat(realfile).st_mtime > mtime:
+                return None
+        except EnvironmentError:
+            return None
+        return digests[basename]
+
+
+class _Inotify(object):
+    """Watches directories using inotify(7), through ctypes"""
+
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 02000000
+    IN_NONBLOCK = 04000
+
+    # Changes to the list of files in a directory
+    DIR_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+               | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._get_errno = ctypes.get_errno
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+        # Watch descriptor to path and the other way around
+        self.paths = {}
+        self.wds = {}
+
+    def _raise(self, filename=None):
+        err = self._get_errno()
+        raise OSError(err, os.strerror(err), filename)
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, path, self.DIR_EVENTS | self.IN_ONLYDIR)
+        if wd < 0:
+            self._raise(path)
+        # The same directory under a new name, after a move
+        old = self.paths.get(wd)
+        if old is not None and old != path:
+            self.wds.pop(old, None)
+        self.paths[wd] = path
+        self.wds[path] = wd
+
+    def add_tree(self, top):
+        """Watches top and all directories below it"""
+        # Watch before listing, a directory created in between is reported
+        try:
+            self.add_watch(top)
+            names = os.listdir(top)
+        except OSError, e:
+            # Removed in the meantime
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise
+
+        for name in names:
+            path = os.path.join(top, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                self.add_tree(path)
+
+    def remove_tree(self, top):
+        """Stops watching top and all directories below it"""
+        for path in [path for path in self.wds if path == top or path.startswith(top + os.sep)]:
+            wd = self.wds.pop(path)
+            if self.paths.get(wd) == path:
+                del self.paths[wd]
+                self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Returns the pending events as (watch descriptor, mask, name) tuples
+
+        Directories can be renamed by earlier events, so use paths to look
+        up the directory only when handling an event."""
+        import struct
+
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = struct.unpack_from('iIII', buf, pos)
+                name = buf[pos + 16:pos + 16 + length].rstrip('\0')
+                pos += 16 + length
+
+                events.append((wd, mask, name))
+        return events
+
+    def forget(self, wd):
+        """Handles IN_IGNORED, the watch was removed"""
+        path = self.paths.pop(wd, None)
+        if path is not None and self.wds.get(path) == wd:
+            del self.wds[path]
+
+    def close(self):
+        os.close(self.fd)
+
+class _Output(object):
+    """Collects what a command prints, unicode is written as UTF-8"""
+
+    softspace = 0
+
+    def __init__(self):
+        self._buf = StringIO()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._buf.write(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return self._buf.getvalue()
+
+class Daemon(BasicInfo):
+    """Answers queries using information kept in memory
+
+    The parsed directory information (see DirectoryInfo) is updated for
+    each file inotify reports as added or removed, so it does not have to
+    be scanned again. Only if events were lost it is read again. The DOAP
+    information is reloaded after DOAP.DOAP_TTL."""
+
+    # Socket the daemon listens on, clients connect to it in main()
+    SOCKET = '/ftp/cache/ftpadmin.sock'
+    # Commands which only read information, these are forwarded to a daemon
+    COMMANDS = ('show-info', 'show-ignored', 'check-latest-is', 'doap',
+                'release-diff', 'simple-diff')
+    # Seconds a client waits for an answer before running the command itself
+    TIMEOUT = 60
+    # Seconds a client has to send its request, and its maximum size; the
+    # requests are read between handling others
+    REQUEST_TIMEOUT = 5
+    MAX_REQUEST = 1024 * 1024
+
+    def __init__(self, path, parser):
+        self.path = path
+        self.parser = parser
+        self.inotify = None
+        self.doap_time = None
+        # Connections still sending their request: (time accepted, data)
+        self.requests = {}
+
+    def serve(self):
+        import select
+        import signal
+
+        self._watch()
+        listener = self._listen()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print "Serving %s on %s" % (self.FTPROOT, self.path)
+        sys.stdout.flush()
+        try:
+            while True:
+                fds = [listener] + self.requests.keys()
+                if self.inotify is not None:
+                    fds.append(self.inotify)
+                timeout = self.REQUEST_TIMEOUT if self.requests else None
+                for fd in select.select(fds, [], [], timeout)[0]:
+                    if fd is listener:
+                        self._accept(listener)
+                    elif fd in self.requests:
+                        self._receive(fd)
+                    elif fd is self.inotify:
+                        self.process_events()
+                self._expire_requests()
+        finally:
+            for conn in self.requests:
+                conn.close()
+            listener.close()
+            os.remove(self.path)
+            self._unwatch()
+
+    def _watch(self):
+        """Starts watching FTPROOT, without that nothing is kept in memory"""
+        try:
+            self.inotify = _Inotify()
+            self.inotify.add_tree(self.FTPROOT)
+        except (OSError, AttributeError), e:
+            # AttributeError: no inotify in libc
+            print >>sys.stderr, "WARNING: Cannot watch %s (%s), directory information is read for every request" % (self.FTPROOT, e)
+            self._unwatch()
+            return
+
+        DirectoryInfo._memory = {}
+
+    def _unwatch(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        DirectoryInfo._memory = None
+
+    def _update(self, path, name, isdir, added):
+        """Updates the directory information covering path"""
+        memory = DirectoryInfo._memory
+        if isdir:
+            # The top of a tree was added or removed, read it again
+            subdir = os.path.join(path, name)
+            for root in memory.keys():
+                if root == subdir or root.startswith(subdir + os.sep):
+                    del memory[root]
+
+        # Update every tree containing path
+        root = path
+        while True:
+            for known in memory.get(root, {}).itervalues():
+                known.update(path, name, isdir, added)
+            if root == self.FTPROOT or root == os.path.dirname(root):
+                break
+            root = os.path.dirname(root)
+
+    def process_events(self):
+        try:
+            events = self.inotify.read_events()
+            for wd, mask, name in events:
+                if mask & _Inotify.IN_Q_OVERFLOW:
+                    # Events were lost, anything might have changed and new
+                    # directories are not watched. Start again; the events
+                    # still pending are for the old watches.
+                    self._unwatch()
+                    self._watch()
+                    return
+                if mask & _Inotify.IN_IGNORED:
+                    self.inotify.forget(wd)
+                    continue
+
+                path = self.inotify.paths.get(wd)
+                if path is None or not name:
+                    # Watch removed meanwhile, or an event for the directory
+                    # itself (also reported for its parent)
+                    continue
+
+                isdir = bool(mask & _Inotify.IN_ISDIR)
+                added = bool(mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO))
+                if isdir:
+                    if added:
+                        self.inotify.add_tree(os.path.join(path, name))
+                    elif mask & _Inotify.IN_MOVED_FROM:
+                        self.inotify.remove_tree(os.path.join(path, name))
+                self._update(path, name, isdir, added)
+        except OSError, e:
+            print >>sys.stderr, "WARNING: Cannot watch %s anymore (%s), directory information is read for every request" % (self.FTPROOT, e)
+            self._unwatch()
+
+    def _listen(self):
+        import socket
+
+        if os.path.exists(self.path):
+            # Only replace the socket of a daemon which is gone
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.connect(self.path)
+            except socket.error:
+                os.remove(self.path)
+            else:
+                print >>sys.stderr, "ERROR: Another daemon is listening on %s" % self.path
+                sys.exit(1)
+            finally:
+                s.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path, 0660)
+        if self.GROUPID is not None:
+            os.chown(self.path, -1, self.GROUPID)
+        listener.listen(16)
+        return listener
+
+    def _accept(self, listener):
+        conn = listener.accept()[0]
+        conn.setblocking(0)
+        self.requests[conn] = (time.time(), [])
+
+    def _receive(self, conn):
+        """Reads what a client sent, the request is complete at EOF"""
+        import socket
+
+        data = self.requests[conn][1]
+        try:
+            chunk = conn.recv(64 * 1024)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            del self.requests[conn]
+            conn.close()
+            return
+
+        if not chunk:
+            del self.requests[conn]
+            self._answer(conn, "".join(data))
+        else:
+            data.append(chunk)
+            if sum(len(buf) for buf in data) > self.MAX_REQUEST:
+                print >>sys.stderr, "WARNING: Invalid request (larger than %d bytes)" % self.MAX_REQUEST
+                del self.requests[conn]
+                conn.close()
+
+    def _expire_requests(self):
+        """Drops the clients which did not send their request in time"""
+        now = time.time()
+        for conn, (accepted, data) in self.requests.items():
+            if now - accepted >= self.REQUEST_TIMEOUT:
+                print >>sys.stderr, "WARNING: Invalid request (not received within %ds)" % self.REQUEST_TIMEOUT
+                del self.requests[conn]
+                conn.close()
+
+    def _answer(self, conn, data):
+        import threading
+
+        reply = None
+        try:
+            request = json.loads(data)
+            argv = [arg.encode('utf-8') for arg in request['argv']]
+
+            start = time.time()
+            # Changes made before the request must be taken into account
+            if self.inotify is not None:
+                self.process_events()
+            result = self.handle(argv, request.get('ftproot'))
+            if result is None:
+                # Closing without an answer makes the client run the command
+                print "%s: %s, refused (for FTPROOT %s)" % (time.strftime('%Y-%m-%d %H:%M:%S'), " ".join(argv), request.get('ftproot'))
+            else:
+                status, out, err = result
+                print "%s: %s, exit status %d, %.3fs" % (time.strftime('%Y-%m-%d %H:%M:%S'), " ".join(argv), status, time.time() - start)
+                reply = "%d %d %d\n" % (status, len(out), len(err)) + out + err
+            sys.stdout.flush()
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            print >>sys.stderr, "WARNING: Invalid request (%s)" % e
+
+        if reply is None:
+            conn.close()
+            return
+
+        # A client which does not read its answer must not hold up others
+        thread = threading.Thread(target=self._send, args=(conn, reply))
+        thread.daemon = True
+        thread.start()
+
+    def _send(self, conn, reply):
+        import socket
+
+        try:
+            conn.settimeout(self.TIMEOUT)
+            conn.sendall(reply)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def handle(self, argv, ftproot):
+        """Runs a command, returns its exit status and output
+
+        Returns None if the client uses another FTPROOT than the daemon."""
+        if ftproot is None or os.path.realpath(ftproot) != os.path.realpath(self.FTPROOT):
+            return None
+
+        if self.doap_time is not None and time.time() - self.doap_time >= DOAP.DOAP_TTL:
+            del ModuleInfo._doap
+            if '_vcs_members' in ModuleInfo.__dict__:
+                del ModuleInfo._vcs_members
+            self.doap_time = None
+
+        stdout, stderr = _Output(), _Output()
+        saved = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = stdout, stderr
+        try:
+            if not argv or argv[0] not in self.COMMANDS:
+                print >>sys.stderr, "ERROR: The daemon only handles %s" % ", ".join(self.COMMANDS)
+                status = 2
+            else:
+                run_command(self.parser.parse_args(argv), self.parser)
+                status = 0
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                print >>sys.stderr, e.code
+                status = 1
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout, sys.stderr = saved
+
+        if self.doap_time is None and '_doap' in ModuleInfo.__dict__:
+            self.doap_time = time.time()
+
+        return status, stdout.getvalue(), stderr.getvalue()
+
+def daemon_request(path, argv):
+    """Has the daemon listening on path run a command
+
+    Prints the output and returns the exit status, None if there is no
+    daemon to ask. A daemon serving another FTPROOT does not answer."""
+    import socket
+
+    try:
+        request = json.dumps({'argv': argv, 'ftproot': BasicInfo.FTPROOT})
+    except UnicodeDecodeError:
+        return None
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(Daemon.TIMEOUT)
+        s.connect(path)
+        s.sendall(request)
+        s.shutdown(socket.SHUT_WR)
+        f = s.makefile('rb')
+        status, outlen, errlen = [int(value) for value in f.readline().split()]
+        out = f.read(outlen)
+        err = f.read(errlen)
+    except (socket.error, ValueError):
+        return None
+    finally:
+        s.close()
+    if len(out) != outlen or len(err) != errlen:
+        return None
+
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    return status
 
 
 def cmd_install(options, parser):
@@ -1502,19 +3213,8 @@ def cmd_install(options, parser):
         parser.print_help()
         sys.exit(2)
 
-    sys.stdout.write("Gathering information and sorting on version: ")
-    modules = []
-    for tarball in tarballs:
-        modules.append(InstallModule(tarball))
-        sys.stdout.write(".")
-    print ", done"
-    modules.sort(cmp=lambda x,y:
-                     x.module and y.module and (cmp(x.module, y.module)
-                                                or version_cmp(x.version, y.version)))
-
-    for module in modules:
-        module.install(unattended=options.unattended, clobber=options.clobber)
-        print ""
+    batch = InstallBatch(tarballs, section=options.section, jobs=options.jobs)
+    batch.install(unattended=options.unattended, clobber=options.clobber)
 
     print """Please report any problems to:
 https://gitlab.gnome.org/Infrastructure/Infrastructure/issues"""
@@ -1532,9 +3232,7 @@ def cmd_notify(options, parser):
         modules.append(InstallModule(tarball))
         sys.stdout.write(".")
     print ", done"
-    modules.sort(cmp=lambda x,y:
-                     x.module and y.module and (cmp(x.module, y.module)
-                                                or version_cmp(x.version, y.version)))
+    modules.sort(key=lambda x: (x.module, version_key(x.version) if x.module else ()))
 
     for module in modules:
         module.inform()
@@ -1575,7 +3273,7 @@ def cmd_check_latest_is(options, parser):
             if majmin not in majmins:
                 majmins[majmin] = []
             majmins[majmin].append(version)
-        for majmin in sorted(majmins.keys(), version_cmp):
+        for majmin in sorted(majmins.keys(), key=version_key):
             max_version = get_latest_version(majmins[majmin])
             latest_is = 'LATEST-IS-%s' % max_version
             has_other_latest = "WRONG" if majmin in latest_dirs else ""
@@ -1616,23 +3314,127 @@ def cmd_show_doap(options, parser):
     if maints:
         print "Maintainers: %s" % ", ".join(sorted(maints))
 
+def cmd_daemon(options, parser):
+    if options.ftproot:
+        BasicInfo.FTPROOT = os.path.abspath(options.ftproot)
+
+    Daemon(options.socket, parser).serve()
+
+def _init_worker():
+    """Initializes a worker process of a multiprocessing pool"""
+    import xztarfile
+
+    # Worker processes cannot create a pool of their own
+    xztarfile.XzTarFile.xz_processes = 1
+
+def _validate_tarball(path, progress=False):
+    """Validates a tarball and returns the result as a dict
+
+    Runs in a worker process when validating in parallel"""
+    tarinfo = TarInfo(path)
+    result = {
+        'path': path,
+        'errors': tarinfo.check(progress=progress)
+    }
+    for attr in ('file_count', 'size_files', 'uniq_dir', 'tar_end_of_data_pos', 'tar_end_of_file_pos'):
+        result[attr] = getattr(tarinfo, attr, None)
+    return result
+
+def _prepare_upload(args):
+    """Validates an upload and creates the files to install
+
+    Runs in a worker process when installing in parallel. The output is
+    returned instead of written, see InstallBatch"""
+    file, section, pw, tmpdir, prev_file = args
+
+    out = _Output()
+    err = _Output()
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = out, err
+    try:
+        result = InstallModule(file, section, pw).prepare(tmpdir, prev_file)
+    finally:
+        sys.stdout, sys.stderr = saved
+    return result, out.getvalue(), err.getvalue()
+
+def _module_news(args):
+    """Returns the errors and the NEWS differences for a module in a suite
+
+    Runs in a worker process when generating news in parallel"""
+    new_file, prev_file = args
+    fn = 'NEWS'
+
+    new_tarinfo = TarInfo(new_file)
+    new_errors = new_tarinfo.load_files()
+    if new_errors:
+        return True, None
+
+    prev_tarinfo = TarInfo(prev_file) if prev_file else None
+
+    constructor = lambda fn: StringIO()
+    diffs = new_tarinfo.diff((fn, ), prev_tarinfo, constructor, progress=False)
+
+    if fn in diffs:
+        return False, diffs[fn].getvalue()
+    return False, None
+
 def cmd_validate_tarballs(options, parser):
-    print options.module, options.section
+    if not options.json:
+        print options.module, options.section
     moduleinfo = ModuleInfo(options.module, section=options.section)
+
+    tarballs = []
     for version in moduleinfo.versions:
-        print "Version: %s" % version
         for format in BasicInfo.FORMATS:
             realpath = moduleinfo.determine_file(version, format, fuzzy=False)
             if realpath is not None:
-                tarinfo = TarInfo(realpath)
-                sys.stdout.write(" - Checking %s: " % format)
-                errors = tarinfo.check(progress=True)
-                if errors:
+                tarballs.append((version, format, realpath))
+
+    results = None
+    pool = None
+    if options.jobs > 1 and len(tarballs) > 1:
+        # Results are returned in order, while the pool continues with
+        # the next tarballs
+        import multiprocessing
+        pool = multiprocessing.Pool(options.jobs, _init_worker)
+        results = pool.imap(_validate_tarball, [realpath for version, format, realpath in tarballs])
+
+    report = []
+    try:
+        tarballs = iter(tarballs)
+        tarball = next(tarballs, None)
+        for version in moduleinfo.versions:
+            if not options.json:
+                print "Version: %s" % version
+            while tarball is not None and tarball[0] == version:
+                version, format, realpath = tarball
+                tarball = next(tarballs, None)
+
+                if not options.json:
+                    sys.stdout.write(" - Checking %s: " % format)
+                if results is not None:
+                    result = results.next()
+                else:
+                    result = _validate_tarball(realpath, progress=not options.json)
+
+                if options.json:
+                    result['version'] = version
+                    result['format'] = format
+                    report.append(result)
+                elif result['errors']:
                     print ", FAILED"
-                    for k, v in errors.iteritems():
+                    for k, v in result['errors'].iteritems():
                         print "ERROR: %s" % v
                 else:
                     print ", success"
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if options.json:
+        json.dump({'module': options.module, 'section': options.section, 'tarballs': report},
+                  sys.stdout, indent=2, sort_keys=True)
+        print ""
 
 def cmd_release_diff(options, parser, header=None):
     oldversion = SuiteInfo(options.suite, options.oldversion)
@@ -1668,11 +3470,23 @@ def cmd_simple_diff(options, parser):
 
         cmd_release_diff(options, parser, header="== %s ==" % suite)
 
+def _news_pool(options):
+    """Returns a pool to generate news with, None if running serially"""
+    if options.jobs > 1:
+        import multiprocessing
+        return multiprocessing.Pool(options.jobs, _init_worker)
+    return None
+
 def cmd_release_news(options, parser, header=None):
     oldversion = SuiteInfo(options.suite, options.oldversion)
     newversion = SuiteInfo(options.suite, options.newversion)
 
-    newversion.diff(oldversion, obj=sys.stdout)
+    pool = _news_pool(options)
+    try:
+        newversion.diff(oldversion, obj=sys.stdout, pool=pool)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
 def cmd_simple_news(options, parser):
     diffs = []
@@ -1695,22 +3509,27 @@ def cmd_simple_news(options, parser):
 
     if do_diff:
         print "Generating news file(s):"
-        for newversion, oldversion in diffs:
-            f = open(os.path.join(newversion.FTPROOT, newversion.relpath, 'NEWS'), 'w')
-            if BasicInfo.GROUPID is not None:
-                os.fchown(f.fileno(), -1, BasicInfo.GROUPID)
-            sys.stdout.write(" - %s " % f.name)
-            newversion.diff(oldversion, obj=f)
-            if f.tell() == 0:
-                os.remove(f.name)
-                print "uninteresting, not saved"
-            else:
-                print "saved"
-            f.close()
+        pool = _news_pool(options)
+        try:
+            for newversion, oldversion in diffs:
+                f = open(os.path.join(newversion.FTPROOT, newversion.relpath, 'NEWS'), 'w')
+                if BasicInfo.GROUPID is not None:
+                    os.fchown(f.fileno(), -1, BasicInfo.GROUPID)
+                sys.stdout.write(" - %s " % f.name)
+                newversion.diff(oldversion, obj=f, pool=pool)
+                if f.tell() == 0:
+                    os.remove(f.name)
+                    print "uninteresting, not saved"
+                else:
+                    print "saved"
+                f.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
 
 def cmd_release_suites(options, parser):
     installer = InstallSuites(options.datafile, options.newversion)
-    installer.install()
+    installer.install(verify=options.verify)
 
 
 def main():
@@ -1730,6 +3549,34 @@ def main():
     else:
         BasicInfo.GROUPID = groupid
 
+    # Let a running daemon answer queries, it has everything loaded already
+    if len(sys.argv) > 1 and sys.argv[1] in Daemon.COMMANDS:
+        status = daemon_request(Daemon.SOCKET, sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+    parser = make_parser()
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(2)
+
+    options = parser.parse_args()
+
+    old_mask = os.umask(0002)
+
+    run_command(options, parser)
+
+def make_parser():
+    # Not needed when a daemon answers the query
+    import argparse
+
+    def jobs(value):
+        jobs = int(value)
+        if jobs < 0:
+            raise argparse.ArgumentTypeError("%s is not a number of jobs" % value)
+        return jobs
+
     description = """Install new tarball(s) to GNOME FTP master and make it available on the mirrors."""
     epilog="""Report bugs to https://bugzilla.gnome.org/enter_bug.cgi?product=sysadmin"""
     parser = argparse.ArgumentParser(description=description,epilog=epilog)
@@ -1745,8 +3592,10 @@ def main():
     subparser.add_argument('tarball', nargs='+', help='Tarball(s) to install')
     subparser.add_argument("-s", "--section", choices=SECTIONS,
                            help="Section to install the file to")
+    subparser.add_argument("-j", "--jobs", type=jobs,
+                           help="Number of tarballs to prepare in parallel (default: one per CPU)")
     subparser.set_defaults(
-        func=cmd_install, clobber=False, unattended=False, section=DEFAULT_SECTION
+        func=cmd_install, clobber=False, unattended=False, section=DEFAULT_SECTION, jobs=0
     )
     #   notify
     subparser = subparsers.add_parser('notify', help='notify new release')
@@ -1774,8 +3623,15 @@ def main():
     subparser = subparsers.add_parser('validate-tarballs', help='validate all tarballs for a given module')
     subparser.add_argument("-s", "--section", choices=SECTIONS,
                            help="Section to install the file to")
+    subparser.add_argument("-j", "--jobs", type=jobs,
+                           help="Number of tarballs to validate in parallel")
+    subparser.add_argument("--json", action="store_true",
+                           help="Output the results as JSON")
+    subparser.add_argument("--no-cache", action="store_true",
+                           help="Do not use the results of previous validations")
     subparser.add_argument('module', help='Module to validate')
-    subparser.set_defaults(func=cmd_validate_tarballs, section=DEFAULT_SECTION)
+    subparser.set_defaults(func=cmd_validate_tarballs, section=DEFAULT_SECTION,
+                           jobs=1, json=False)
     #   show-ignored
     subparser = subparsers.add_parser('show-ignored', help='Show ignored files in a module')
     subparser.add_argument("-s", "--section", choices=SECTIONS,
@@ -1805,26 +3661,38 @@ def main():
                            help='Suite to compare')
     subparser.add_argument('oldversion', metavar='OLDVERSION', help='Previous GNOME version')
     subparser.add_argument('newversion', metavar='NEWVERSION', help='New GNOME version')
-    subparser.set_defaults(func=cmd_release_news, suite=DEFAULT_SUITE)
+    subparser.add_argument("--no-cache", action="store_true",
+                           help="Do not use the results of previous tarball validations")
+    subparser.add_argument("-j", "--jobs", type=jobs,
+                           help="Number of modules to generate news for in parallel")
+    subparser.set_defaults(func=cmd_release_news, suite=DEFAULT_SUITE, jobs=1)
     # simple-news
     subparser = subparsers.add_parser('simple-news', help='Create NEWS file between two GNOME versions')
     subparser.add_argument('oldversion', metavar='OLDVERSION', help='Previous GNOME version')
     subparser.add_argument('newversion', metavar='NEWVERSION', help='New GNOME version')
-    subparser.set_defaults(func=cmd_simple_news)
+    subparser.add_argument("--no-cache", action="store_true",
+                           help="Do not use the results of previous tarball validations")
+    subparser.add_argument("-j", "--jobs", type=jobs,
+                           help="Number of modules to generate news for in parallel")
+    subparser.set_defaults(func=cmd_simple_news, jobs=1)
     # release-suites
     subparser = subparsers.add_parser('release-suites', help='release a new GNOME version')
     subparser.add_argument('newversion', metavar='NEWVERSION', help='New GNOME version')
     subparser.add_argument('datafile', metavar='DATAFILE', help='file which describes which modules to include')
-    subparser.set_defaults(func=cmd_release_suites)
-
-
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit(2)
-
-    options = parser.parse_args()
-
-    old_mask = os.umask(0002)
+    subparser.add_argument("--verify", action="store_true",
+                           help="Hash all tarballs and compare against the sha256sum files of the modules")
+    subparser.set_defaults(func=cmd_release_suites, verify=False)
+    # daemon
+    subparser = subparsers.add_parser('daemon', help='answer queries (%s) from memory' % ", ".join(Daemon.COMMANDS))
+    subparser.add_argument("--socket", help="UNIX socket to listen on (default: %s)" % Daemon.SOCKET)
+    subparser.add_argument("--ftproot", help="Serve this directory instead of %s" % BasicInfo.FTPROOT)
+    subparser.set_defaults(func=cmd_daemon, socket=Daemon.SOCKET, ftproot=None)
+
+    return parser
+
+def run_command(options, parser):
+    if getattr(options, 'no_cache', False):
+        TarInfo.USE_CACHE = False
 
     if DEBUG:
         print "WARNING: Running in DEBUG MODE!"
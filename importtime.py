@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# Reports the time spent importing modules while running ftpadmin, in the
+# format of "python3 -X importtime" (Python 2 has no such option):
+#
+#   ./importtime.py show-ignored gnome-shell 2>&1 >/dev/null | sort -t'|' -k2 -n
+#
+# Arguments are passed to ftpadmin. Without arguments only the import of
+# ftpadmin itself and the argument parsing (--help) is measured.
+
+import sys
+import os
+import time
+import __builtin__
+
+_import = __builtin__.__import__
+_stack = []
+_report = []
+
+def _timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    known = set(sys.modules)
+    _stack.append(0.0)
+    start = time.time()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        total = time.time() - start
+        nested = _stack.pop()
+        if _stack:
+            _stack[-1] += total
+        new = [m for m in sys.modules if m not in known and sys.modules[m] is not None]
+        if new:
+            if name not in new:
+                # e.g. a relative import, or a package imported with it
+                name = min(new, key=len)
+            _report.append((total - nested, total, len(_stack), name))
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.realpath(os.path.abspath(__file__))))
+    sys.argv = ['ftpadmin'] + (sys.argv[1:] or ['--help'])
+
+    start = time.time()
+    __builtin__.__import__ = _timed_import
+    try:
+        import ftpadmin
+        try:
+            ftpadmin.main()
+        except SystemExit:
+            pass
+    finally:
+        __builtin__.__import__ = _import
+        elapsed = time.time() - start
+
+        print >>sys.stderr, "import time: self [us] | cumulative | imported package"
+        for (own, total, depth, name) in _report:
+            print >>sys.stderr, "import time: %9d | %10d | %s%s" % (own * 1e6, total * 1e6, "  " * depth, name)
+        print >>sys.stderr, "total: %d us (imports %d us)" % (
+            elapsed * 1e6, sum(r[0] for r in _report) * 1e6)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+#
+# Checks that the optimized helpers of ftpadmin give the same results as
+# the straightforward implementations they replace, on generated inputs
+# and on the NEWS and ChangeLog of the tarball next to this script:
+#
+#   ./selfcheck.py [count] [seed] [NEWS/ChangeLog files...]
+#
+# Exits with status 1 and shows the first mismatches if there are any.
+
+import sys
+import os
+import random
+import difflib
+import tarfile
+
+def random_version(rnd):
+    """Returns a version, mostly like a real one but with all the odd
+    parts version_cmp has to deal with"""
+    parts = []
+    for i in xrange(rnd.randint(1, 6)):
+        kind = rnd.random()
+        if kind < 0.6:
+            part = str(rnd.randint(0, 30))
+        elif kind < 0.7:
+            part = '0' + str(rnd.randint(0, 30))
+        elif kind < 0.8:
+            part = rnd.choice(('alpha', 'beta', 'rc', 'RC', 'pre', 'a', 'B'))
+        elif kind < 0.9:
+            part = rnd.choice(('_', '+', '~', '!', 'z', 'Z', '#'))
+        else:
+            part = ''
+        parts.append(part)
+        parts.append(rnd.choice(('.', '.', '.', '-', '')))
+    version = ''.join(parts)
+    if rnd.random() < 0.05:
+        version = '0' * rnd.randint(1, 2) + version
+    return version
+
+def check_version_key(ftpadmin, rnd, count, files):
+    """version_key must order versions exactly like version_cmp"""
+    errors = []
+    for i in xrange(count):
+        a = random_version(rnd)
+        b = random_version(rnd) if rnd.random() < 0.9 else a.upper()
+        expected = ftpadmin.version_cmp(a, b)
+        got = cmp(ftpadmin.version_key(a), ftpadmin.version_key(b))
+        if expected != got:
+            errors.append("version_key: %r vs %r gives %d, version_cmp %d" % (a, b, got, expected))
+    return errors
+
+def difflib_news_head(a, b):
+    """The new lines TarInfo.diff used to write, before news_head"""
+    lines = []
+    for group in difflib.SequenceMatcher(None, a, b).get_grouped_opcodes(0):
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'replace' or tag == 'insert':
+                lines.extend(b[j1:j2])
+        if lines:
+            break
+    return lines
+
+def random_news_pair(rnd):
+    """Returns a NEWS/ChangeLog like file and a changed version of it,
+    repetitive so there are many ways to align the lines"""
+    vocabulary = ['', '', '* Updated translations', '2010-09-14  Someone',
+                  '\tReviewed by: someone'] + ['line %d' % i for i in xrange(rnd.choice((2, 5, 50, 1000)))]
+    line = lambda: rnd.choice(vocabulary) if rnd.random() < 0.9 else 'new %d' % rnd.randint(0, 10)
+    a = [line() for i in xrange(rnd.choice((0, 1, 3, 10, 50, 250, 600)))]
+
+    pos = rnd.randint(0, len(a))
+    count = rnd.randint(0, 30)
+    kind = rnd.random()
+    if kind < 0.4:
+        b = [line() for i in xrange(count)] + a
+    elif kind < 0.6:
+        b = a[:pos] + [line() for i in xrange(count)] + a[pos:]
+    elif kind < 0.7:
+        b = a[:pos] + a[pos + count:]
+    elif kind < 0.9:
+        b = a[:pos] + [line() for i in xrange(count)] + a[pos + rnd.randint(0, 10):]
+    else:
+        b = [line() for i in xrange(len(a) + rnd.randint(-5, 5))]
+    return a, b
+
+def real_news_pairs(name, lines):
+    """Returns the pairs of successive releases of a NEWS or ChangeLog,
+    each entry starts on an unindented line after an empty line"""
+    starts = [i for i in xrange(len(lines))
+              if lines[i].strip() and not lines[i][0].isspace() and (i == 0 or not lines[i - 1].strip())]
+    return [('%s:%d' % (name, new), lines[old:], lines[new:]) for new, old in zip(starts, starts[1:])]
+
+def check_news_head(ftpadmin, rnd, count, files):
+    """news_head must give the same lines as difflib did"""
+    # Prefix and suffix match, but difflib aligns a with the middle of b
+    corpus = [('shifted', ['x', 'y'], ['x', 'x', 'y', 'y'])]
+    path = os.path.join(os.path.dirname(os.path.realpath(os.path.abspath(__file__))), 'pessulus-2.30.3.tar.gz')
+    with tarfile.open(path) as tar:
+        for member in tar.getmembers():
+            if os.path.basename(member.name) in ftpadmin.BasicInfo.DIFF_FILES_DICT:
+                corpus.extend(real_news_pairs(member.name, tar.extractfile(member).readlines()))
+    for fn in files:
+        with open(fn, 'rb') as f:
+            corpus.extend(real_news_pairs(fn, f.readlines()))
+    for i in xrange(count // 100):
+        corpus.append(('generated %d' % i,) + random_news_pair(rnd))
+
+    errors = []
+    for name, a, b in corpus:
+        head = ftpadmin.news_head(a, b)
+        got = b[head[0]:head[1]] if head is not None else []
+        expected = difflib_news_head(a, b)
+        if got != expected:
+            errors.append("news_head: %s gives %d lines %r, difflib %d lines %r"
+                          % (name, len(got), got[:3], len(expected), expected[:3]))
+    return errors
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.realpath(os.path.abspath(__file__))))
+    import ftpadmin
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    files = sys.argv[3:]
+
+    failed = False
+    for check in (check_version_key, check_news_head):
+        errors = check(ftpadmin, random.Random(seed), count, files)
+        if errors:
+            failed = True
+            print "%s: %d mismatches" % (check.__name__, len(errors))
+            for error in errors[:10]:
+                print "  %s" % error
+        else:
+            print "%s: ok" % check.__name__
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -39,16 +39,48 @@ class UrlResource(str):
 class ParseError(Exception):
     pass
 
-class Node:
+class Node(object):
+    __slots__ = ('name', 'about', 'properties', '_index', '_indexed', '_count')
+
     def __init__(self, name, about=None):
         self.name  = name
         self.about = None
         self.properties = []
+        self._index = None
+        self._indexed = None
+        self._count = 0
+
+    def _lookup(self, name):
+        # Returns the [(lang, value)] of a predicate from an index, or None
+        # if the properties should be scanned instead. Most nodes are queried
+        # only once, so the index is only built when a node is queried again
+        # and rebuilt when properties was replaced or appended to.
+        properties = self.properties
+        if self._indexed is not properties or self._count != len(properties):
+            self._indexed = properties
+            self._count = len(properties)
+            self._index = None
+            return None
+
+        index = self._index
+        if index is None:
+            index = self._index = {}
+            for (n, l, v) in properties:
+                index.setdefault(n, []).append((l, v))
+        return index.get(name, ())
 
     def find_property(self, name, lang="en"):
         value = None
-        for (n, l, v) in self.properties:
-            if n == name:
+        values = self._lookup(name)
+        if values is None:
+            for (n, l, v) in self.properties:
+                if n == name:
+                    if l == lang:
+                        return v
+                    elif l == None or value == None:
+                        value = v
+        else:
+            for (l, v) in values:
                 if l == lang:
                     return v
                 elif l == None or value == None:
@@ -58,12 +90,14 @@ class Node:
 
     def find_properties(self, name, lang="en"):
         value = None
-        for (n, l, v) in self.properties:
-            if n == name:
-                if l == lang:
-                    yield v
-                elif l == None or value == None:
-                    yield v
+        values = self._lookup(name)
+        if values is None:
+            values = [(l, v) for (n, l, v) in self.properties if n == name]
+        for (l, v) in values:
+            if l == lang:
+                yield v
+            elif l == None or value == None:
+                yield v
 
     def add_property(self, name, lang, value):
         self.properties.append((name, lang, value))
@@ -72,7 +106,9 @@ class Node:
         self.properties = filter(lambda x: x[0] != name, self.properties)
 
 class RdfHandler(xml.sax.handler.ContentHandler):
-    def __init__(self):
+    def __init__(self, keep=None):
+        # If given, only properties with these predicates are stored
+        self.keep = keep
         self.nodes = []
         self.__node_stack = []
         self.__property_stack = []
@@ -116,7 +152,7 @@ class RdfHandler(xml.sax.handler.ContentHandler):
                 else:
                     if node == None:
                         node = Node(None)
-                    node.properties.append((attrname, lang, attributes.getValue(attrname)))
+                    self.addProperty(node, attrname, lang, attributes.getValue(attrname))
             self.__property_stack.append((name, lang, resource))
             if node is not None:
                 self.__node_stack.append(node)
@@ -130,7 +166,11 @@ class RdfHandler(xml.sax.handler.ContentHandler):
                 if attrname == (RDF, "about"):
                     node.about = attributes.getValue(attrname)
                 else:
-                    node.properties.append((attrname, lang, attributes.getValue(attrname)))
+                    self.addProperty(node, attrname, lang, attributes.getValue(attrname))
+
+    def addProperty(self, node, predicate, lang, obj):
+        if self.keep is None or predicate in self.keep:
+            node.properties.append((predicate, lang, obj))
 
     def popProperty(self):
         (predicate, lang, resource) = self.__property_stack.pop()
@@ -141,7 +181,7 @@ class RdfHandler(xml.sax.handler.ContentHandler):
         else:
             obj = resource
         self.__object = None
-        self.__node_stack[-1].properties.append((predicate, lang, obj))
+        self.addProperty(self.__node_stack[-1], predicate, lang, obj)
 
     def popNode(self):
         node = self.__node_stack.pop()
@@ -175,6 +215,36 @@ def read_rdf(f):
 
     return handler.nodes
 
+def iter_rdf(f, names=None, keep=None, blocksize=64*1024):
+    """Like read_rdf, but parses f incrementally and yields the nodes as
+    soon as they are complete (in the same order as read_rdf returns them).
+
+    If names is given, only nodes with one of these names are yielded. If
+    keep is given, only properties with one of these predicates are kept,
+    on all nodes. Nodes which are not yielded nor referenced by a kept
+    property are not kept in memory."""
+    handler = RdfHandler(keep)
+
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+    parser.setFeature(xml.sax.handler.feature_namespaces, 1)
+
+    while True:
+        buf = f.read(blocksize)
+        if buf:
+            parser.feed(buf)
+        else:
+            parser.close()
+
+        nodes = handler.nodes
+        handler.nodes = []
+        for node in nodes:
+            if names is None or node.name in names:
+                yield node
+
+        if not buf:
+            break
+
 def qualname(name, namespaces):
     if name[0] is None:
         return name[1]
@@ -254,8 +324,10 @@ def dump_rdf(nodes, f):
             f.write('\n    xmlns:%s="%s"' % (name, url))
     f.write('>\n')
 
-    for node in toplevel_nodes:
-        _dump_node(f, node, None, namespaces)
+    # Keep the order of nodes, the order of a set depends on object addresses
+    for node in nodes:
+        if node in toplevel_nodes:
+            _dump_node(f, node, None, namespaces)
 
     f.write('</rdf:RDF>\n')
 
@@ -0,0 +1,471 @@
+# xz support for tarfile, used by ftpadmin
+#
+# Importing this module makes tarfile.open() handle xz compressed tarballs
+# (see XzTarFile). It is kept apart from ftpadmin.py so that commands which
+# do not read or write tarballs do not have to import tarfile and lzma.
+#
+# Needs pyliblzma (the "lzma" module of Python 2, tested with 0.5.3), which
+# is installed on the system and not shipped with ftpadmin.
+
+import struct
+import zlib
+import bisect
+import collections
+import multiprocessing
+import gzip
+import tarfile
+import lzma # pyliblzma
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+class _LZMAProxy(object):
+    """Small proxy class that enables external file object
+       support for "r:lzma" and "w:lzma" modes. This is actually
+       a workaround for a limitation in lzma module's LZMAFile
+       class which (unlike gzip.GzipFile) has no support for
+       a file object argument.
+
+       Decompressed data is kept in a bytearray. Reads hand out slices
+       of it without copying the rest of the buffer around. The last
+       keepsize bytes which were already read are retained, so (small)
+       backward seeks, such as the one done by XzTarFile.xzopen, do not
+       restart the decompression.
+    """
+
+    blocksize = 16 * 1024
+    keepsize = 64 * 1024
+
+    def __init__(self, fileobj, mode, close_fileobj=False):
+        self.fileobj = fileobj
+        self.mode = mode
+        self.close_fileobj = close_fileobj
+        self.name = getattr(self.fileobj, "name", None)
+        self.init()
+
+    def init(self):
+#        import lzma
+        self.pos = 0
+        if self.mode == "r":
+            self.lzmaobj = lzma.LZMADecompressor()
+            self.fileobj.seek(0)
+            self.buf = bytearray()
+            # Position in the decompressed stream of self.buf[0]
+            self.bufpos = 0
+            self.eof = False
+        else:
+            self.lzmaobj = lzma.LZMACompressor()
+
+    def _fill(self, size):
+        """Decompress until at least size bytes are available after the
+           current position (or the end of the stream is reached)"""
+        offset = self.pos - self.bufpos
+        if offset > 2 * self.keepsize:
+            # Drop data which is not needed anymore
+            drop = offset - self.keepsize
+            del self.buf[:drop]
+            self.bufpos += drop
+            offset -= drop
+
+        while not self.eof and len(self.buf) - offset < size:
+            raw = self.fileobj.read(self.blocksize)
+            if not raw:
+                self.eof = True
+                break
+            try:
+                data = self.lzmaobj.decompress(raw)
+            except EOFError:
+                self.eof = True
+                break
+            self.buf.extend(data)
+
+        return offset
+
+    def read(self, size):
+        offset = self._fill(size)
+
+        buf = str(buffer(self.buf, offset, size))
+        self.pos += len(buf)
+        return buf
+
+    def seek(self, pos):
+        if pos < self.bufpos:
+            self.init()
+
+        # Skip forward, only retaining the last part of the skipped data
+        while pos > self.bufpos + len(self.buf) and not self.eof:
+            self.pos = self.bufpos + len(self.buf)
+            self._fill(self.blocksize)
+        self.pos = min(pos, self.bufpos + len(self.buf))
+
+    def tell(self):
+        return self.pos
+
+    def write(self, data):
+        self.pos += len(data)
+        raw = self.lzmaobj.compress(data)
+        self.fileobj.write(raw)
+
+    def close(self):
+        if self.mode == "w":
+            raw = self.lzmaobj.flush()
+            self.fileobj.write(raw)
+        if self.close_fileobj:
+            self.fileobj.close()
+
+
+XZ_HEADER_MAGIC = '\xfd7zXZ\x00'
+XZ_FOOTER_MAGIC = 'YZ'
+
+def _xz_decode_int(buf, pos):
+    """Decodes a xz multibyte integer, returns value and new position"""
+    value = 0
+    for i in xrange(9):
+        byte = ord(buf[pos + i])
+        value |= (byte & 0x7f) << (i * 7)
+        if not byte & 0x80:
+            return value, pos + i + 1
+    raise ValueError("invalid multibyte integer")
+
+def _xz_encode_int(value):
+    buf = []
+    while value >= 0x80:
+        buf.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    buf.append(chr(value))
+    return "".join(buf)
+
+def _xz_crc32(data):
+    return struct.pack('<I', zlib.crc32(data) & 0xffffffff)
+
+def xz_blocks(fileobj):
+    """Determine the blocks within a xz file by parsing its index
+
+    Returns a list of (stream flags, offset, unpadded size,
+    uncompressed size) tuples, in file order. Raises ValueError if the
+    file cannot be parsed."""
+    fileobj.seek(0, 2)
+    pos = fileobj.tell()
+
+    streams = []
+    while pos > 0:
+        # Skip stream padding
+        while pos >= 4:
+            fileobj.seek(pos - 4)
+            if fileobj.read(4) != '\x00' * 4:
+                break
+            pos -= 4
+
+        if pos < 24:
+            raise ValueError("file too small")
+
+        fileobj.seek(pos - 12)
+        footer = fileobj.read(12)
+        if footer[10:12] != XZ_FOOTER_MAGIC or _xz_crc32(footer[4:10]) != footer[0:4]:
+            raise ValueError("invalid stream footer")
+        flags = footer[8:10]
+        index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+
+        index_pos = pos - 12 - index_size
+        if index_pos < 12:
+            raise ValueError("invalid index size")
+        fileobj.seek(index_pos)
+        index = fileobj.read(index_size)
+        if index[0] != '\x00' or _xz_crc32(index[:-4]) != index[-4:]:
+            raise ValueError("invalid index")
+
+        count, i = _xz_decode_int(index, 1)
+        records = []
+        for n in xrange(count):
+            unpadded, i = _xz_decode_int(index, i)
+            uncompressed, i = _xz_decode_int(index, i)
+            records.append((unpadded, uncompressed))
+
+        blocks_size = sum([(unpadded + 3) & ~3 for unpadded, uncompressed in records])
+        stream_pos = index_pos - blocks_size - 12
+        if stream_pos < 0:
+            raise ValueError("invalid index")
+        fileobj.seek(stream_pos)
+        header = fileobj.read(12)
+        if header[0:6] != XZ_HEADER_MAGIC or header[6:8] != flags:
+            raise ValueError("invalid stream header")
+
+        blocks = []
+        offset = stream_pos + 12
+        for unpadded, uncompressed in records:
+            blocks.append((flags, offset, unpadded, uncompressed))
+            offset += (unpadded + 3) & ~3
+        streams.append(blocks)
+
+        pos = stream_pos
+
+    return [block for blocks in reversed(streams) for block in blocks]
+
+def _xz_block_stream(flags, block, unpadded, uncompressed):
+    """Wraps a single xz block into a standalone xz stream"""
+    index = ''.join(('\x00', _xz_encode_int(1),
+                     _xz_encode_int(unpadded), _xz_encode_int(uncompressed)))
+    index += '\x00' * (-len(index) % 4)
+    index += _xz_crc32(index)
+    backward = struct.pack('<I', len(index) / 4 - 1) + flags
+
+    return ''.join((XZ_HEADER_MAGIC, flags, _xz_crc32(flags),
+                    block,
+                    index,
+                    _xz_crc32(backward), backward, XZ_FOOTER_MAGIC))
+
+def _xz_decode_block(args):
+    """Decompress one xz block (runs in a worker process)"""
+    path, (flags, offset, unpadded, uncompressed) = args
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        block = f.read((unpadded + 3) & ~3)
+
+    data = lzma.LZMADecompressor().decompress(_xz_block_stream(flags, block, unpadded, uncompressed))
+    if len(data) != uncompressed:
+        raise lzma.error("block has an unexpected size")
+    return data
+
+class _XzBlockReader(object):
+    """Read-only file object which decompresses the blocks of a multi-block
+       xz file (e.g. created by xz -T0) in parallel using a process pool.
+
+       Blocks are handed out in order. Backward seeks restart at the block
+       containing the wanted position instead of at the start of the file.
+    """
+
+    # Number of decompressed blocks which are allowed to be ahead of the
+    # reader (per process)
+    readahead = 2
+
+    def __init__(self, name, blocks, processes):
+        self.name = name
+        self.blocks = blocks
+        self.starts = []
+        start = 0
+        for flags, offset, unpadded, uncompressed in blocks:
+            self.starts.append(start)
+            start += uncompressed
+        self.size = start
+
+        self.processes = processes
+        self.pool = multiprocessing.Pool(min(self.processes, len(blocks)))
+        self._restart(0)
+
+    def _restart(self, block):
+        """Continue decompressing at the given block"""
+        self.pending = collections.deque()
+        self.next_block = block
+        self.buf = ""
+        self.bufpos = self.starts[block] if block < len(self.blocks) else self.size
+        self.pos = self.bufpos
+        self._submit()
+
+    def _submit(self):
+        while self.next_block < len(self.blocks) and \
+              len(self.pending) < self.processes * self.readahead:
+            self.pending.append(self.pool.apply_async(
+                _xz_decode_block, ((self.name, self.blocks[self.next_block]),)))
+            self.next_block += 1
+
+    def _next_buf(self):
+        if not self.pending:
+            return False
+        self.bufpos += len(self.buf)
+        self.buf = self.pending.popleft().get()
+        self._submit()
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.pos
+
+        b = []
+        while size > 0:
+            offset = self.pos - self.bufpos
+            if offset >= len(self.buf) and not self._next_buf():
+                break
+            offset = self.pos - self.bufpos
+            data = self.buf[offset:offset + size]
+            b.append(data)
+            self.pos += len(data)
+            size -= len(data)
+        return "".join(b)
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        pos = min(max(pos, 0), self.size)
+        if pos < self.bufpos:
+            self._restart(bisect.bisect_right(self.starts, pos) - 1)
+
+        while pos >= self.bufpos + len(self.buf) and self._next_buf():
+            pass
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+def _xz_encode_chunk(data):
+    """Compress data into a single-block xz stream (runs in a worker process)"""
+    compressor = lzma.LZMACompressor()
+    return compressor.compress(data) + compressor.flush()
+
+class _XzBlockWriter(object):
+    """Write-only file object which compresses into a multi-block xz stream
+       (like xz -T0) using a process pool.
+
+       The data is split into chunks of blocksize, which are compressed in
+       parallel as separate streams. Their blocks are combined into one
+       stream with a new index, so any xz decoder can read the result.
+    """
+
+    # Uncompressed size of a block, same as xz uses for the default preset
+    blocksize = 24*1024*1024
+
+    # Number of compressed blocks which are allowed to wait for being
+    # written (per process)
+    backlog = 2
+
+    def __init__(self, fileobj, processes):
+        self.fileobj = fileobj
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes)
+        self.pending = collections.deque()
+        self.buf = []
+        self.bufsize = 0
+        self.flags = None
+        self.records = []
+
+    def _submit(self, data):
+        while len(self.pending) >= self.processes * self.backlog:
+            self._write_block()
+        self.pending.append(self.pool.apply_async(_xz_encode_chunk, (data,)))
+
+    def _write_block(self):
+        stream = self.pending.popleft().get()
+        for flags, offset, unpadded, uncompressed in xz_blocks(StringIO(stream)):
+            if self.flags is None:
+                self.flags = flags
+                self.fileobj.write(XZ_HEADER_MAGIC + flags + _xz_crc32(flags))
+            self.fileobj.write(stream[offset:offset + ((unpadded + 3) & ~3)])
+            self.records.append((unpadded, uncompressed))
+
+    def write(self, data):
+        self.buf.append(data)
+        self.bufsize += len(data)
+        if self.bufsize >= self.blocksize:
+            data = "".join(self.buf)
+            for pos in xrange(0, len(data) - self.blocksize + 1, self.blocksize):
+                self._submit(data[pos:pos + self.blocksize])
+            rest = data[pos + self.blocksize:]
+            self.buf = [rest]
+            self.bufsize = len(rest)
+
+    def close(self):
+        if self.pool is None:
+            return
+
+        if self.bufsize:
+            self._submit("".join(self.buf))
+        self.buf = []
+        while self.pending:
+            self._write_block()
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+        if not self.records:
+            # Nothing written, a stream without blocks
+            self.fileobj.write(_xz_encode_chunk(""))
+            return
+
+        index = ''.join(['\x00', _xz_encode_int(len(self.records))] +
+                        [_xz_encode_int(unpadded) + _xz_encode_int(uncompressed)
+                         for unpadded, uncompressed in self.records])
+        index += '\x00' * (-len(index) % 4)
+        index += _xz_crc32(index)
+        backward = struct.pack('<I', len(index) / 4 - 1) + self.flags
+        self.fileobj.write(index + _xz_crc32(backward) + backward + XZ_FOOTER_MAGIC)
+
+def xz_compressor(fileobj, processes=None):
+    """Returns a file object compressing into fileobj, using a multi-block
+       stream if more than one process is available"""
+    processes = processes or XzTarFile.xz_processes or multiprocessing.cpu_count()
+    if processes > 1:
+        return _XzBlockWriter(fileobj, processes)
+    return _LZMAProxy(fileobj, 'w')
+
+
+class XzTarFile(tarfile.TarFile):
+
+    OPEN_METH = tarfile.TarFile.OPEN_METH.copy()
+    OPEN_METH["xz"] = "xzopen"
+
+    # Processes used for decompressing multi-block xz files and for
+    # creating them (None means one per CPU, 1 disables both)
+    xz_processes = None
+
+    @classmethod
+    def xzopen(cls, name, mode="r", fileobj=None, **kwargs):
+        """Open gzip compressed tar archive name for reading or writing.
+           Appending is not allowed.
+        """
+        if len(mode) > 1 or mode not in "rw":
+            raise ValueError("mode must be 'r' or 'w'")
+
+        if fileobj is not None:
+            fileobj = _LZMAProxy(fileobj, mode)
+        elif mode == "r":
+            fileobj = open(name, "rb")
+            try:
+                blocks = xz_blocks(fileobj)
+            except (ValueError, IndexError, struct.error):
+                # Not a (valid) xz file; have the proxy report the error
+                blocks = []
+
+            processes = cls.xz_processes or multiprocessing.cpu_count()
+            if len(blocks) > 1 and processes > 1:
+                fileobj.close()
+                fileobj = _XzBlockReader(name, blocks, processes)
+            else:
+                fileobj = _LZMAProxy(fileobj, mode, close_fileobj=True)
+        else:
+            fileobj = lzma.LZMAFile(name, mode)
+
+        try:
+            # lzma doesn't immediately return an error
+            # try and read a bit of data to determine if it is a valid xz file
+            fileobj.read(_LZMAProxy.blocksize)
+            fileobj.seek(0)
+            t = cls.taropen(name, mode, fileobj, **kwargs)
+        except IOError:
+            fileobj.close()
+            raise tarfile.ReadError("not a xz file")
+        except lzma.error:
+            fileobj.close()
+            raise tarfile.ReadError("not a xz file")
+        t._extfileobj = False
+        return t
+
+if not hasattr(tarfile.TarFile, 'xzopen'):
+    tarfile.open = XzTarFile.open
+
+
+def open_compressor(comptype, name, fileobj):
+    """Returns a file object compressing into fileobj, comptype is a
+       compression name as in tarfile.TarFile.OPEN_METH"""
+    if comptype == 'gz':
+        return gzip.GzipFile(name, 'wb', 9, fileobj)
+    if comptype == 'bz2':
+        return tarfile._BZ2Proxy(fileobj, 'w')
+    if comptype == 'xz':
+        return xz_compressor(fileobj)
+    raise tarfile.CompressionError("unknown compression type %r" % comptype)